@@ -9,6 +9,13 @@ from .models import db
 # by importing controllers you expose the actions defined in it
 from . import controllers
 
+# the static urls change with the files, see StaticAssets
+from . import settings
+from .common import static_assets
+
+if settings.STATIC_ASSETS:
+    __static_version__ = static_assets.version()
+
 # optional parameters
 __version__ = "0.0.0"
 __author__ = "you <you@example.com>"
@@ -0,0 +1,106 @@
+"""
+ASGI endpoint for the datatables.net data call
+
+Answers the same calls as the datatables_data action, but the queries run on a pool of db
+threads behind asyncio, so a single process can hold hundreds of slow searches in flight
+while only ASYNC_DB_POOL_SIZE of them use a connection.  Serve it with any ASGI server,
+from the folder that contains apps/:
+
+    uvicorn apps.simple_table.asgi:application --port 8001
+
+and point the data_url of the DataTablesResponse at it.
+"""
+import asyncio
+from urllib.parse import parse_qsl
+
+from . import settings
+from .common import db, cache
+from .controllers import (
+    zip_code_columnar,
+    zip_code_data_json,
+    zip_code_datatables_request,
+    zip_code_interrupted,
+    zip_code_results,
+    zip_code_statements,
+)
+from .libs.async_db import ReadPool
+from .libs.interrupt import QueryInterrupted
+
+pool = ReadPool(db, size=settings.ASYNC_DB_POOL_SIZE)
+
+
+async def datatables_data(get_vars):
+    """
+    async version of controllers.datatables_data, the same json
+
+    the sql is built (or taken from the statement cache) on the event loop, only the
+    execution goes to the pool where the counts and the page run at the same time
+
+    :param get_vars: vars supplied by datatables.net
+    :return: the json for datatables.net
+    """
+    dtr = zip_code_datatables_request(get_vars)
+    #  read before the data, the pages kept by the browser are dropped when it changes
+    version = cache.generation("zip_code")
+
+    response = zip_code_columnar(dtr)
+    if response is None:
+        budget = settings.DATATABLES_QUERY_BUDGET
+        try:
+            results = await asyncio.gather(
+                *[
+                    pool.execute(sql, budget, placeholders, version)
+                    for sql, placeholders in zip_code_statements(dtr)
+                ]
+            )
+            response = zip_code_results(dtr, results)
+        except QueryInterrupted as e:
+            response = zip_code_interrupted(dtr, e)
+
+    return zip_code_data_json(dtr, response, version)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            pool.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    status, body = 404, b"not found"
+    content_type = b"text/plain"
+    if scope["path"].rstrip("/").endswith("/datatables_data") and scope["method"] in (
+        "GET",
+        "POST",
+    ):
+        get_vars = dict(parse_qsl(scope["query_string"].decode()))
+        if scope["method"] == "POST":
+            form = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                form += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            get_vars.update(parse_qsl(form.decode()))
+        status, body = 200, (await datatables_data(get_vars)).encode()
+        content_type = b"application/json"
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
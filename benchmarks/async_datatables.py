@@ -0,0 +1,118 @@
+"""
+Concurrent slow datatables searches, sync action vs async endpoint
+
+Fires --requests searches that match nothing (full LIKE scan plus two counts) at the same
+time.  The sync action gets --threads worker threads like a threaded server, the rest of
+the requests wait for a thread.  The async endpoint takes all of them on one event loop
+thread and runs the sql on ASYNC_DB_POOL_SIZE db threads.  From the folder that contains
+apps/:
+
+    python -m apps.simple_table.benchmarks.async_datatables --requests 200 --threads 10
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from py4web import request, response
+
+from .. import settings
+from ..asgi import application, pool
+from ..controllers import datatables_data
+
+PATH = "/simple_table/datatables_data"
+QUERY_STRING = urlencode(
+    {
+        "start": 0,
+        "length": 15,
+        "search[value]": "no such city",
+        "columns[1][name]": "zip_code",
+        "order[0][column]": 1,
+        "order[0][dir]": "asc",
+    }
+)
+
+
+def sync_call(started):
+    request.bind(
+        {"REQUEST_METHOD": "GET", "PATH_INFO": PATH, "QUERY_STRING": QUERY_STRING}
+    )
+    request.app_name = "simple_table"
+    response.bind()
+    datatables_data()
+    return time.perf_counter() - started
+
+
+async def async_call(started):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": PATH,
+        "query_string": QUERY_STRING.encode(),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    await application(scope, receive, send)
+    return time.perf_counter() - started
+
+
+def measure_sync(requests, threads):
+    """
+    :return: (seconds for all the requests, latencies, threads used)
+    """
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        #  all the requests arrive at once, the latency includes the wait for a thread
+        futures = [executor.submit(sync_call, started) for _ in range(requests)]
+        latencies = [f.result() for f in futures]
+    return time.perf_counter() - started, latencies, threads
+
+
+async def measure_async(requests):
+    """
+    :return: (seconds for all the requests, latencies, threads used)
+    """
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[async_call(started) for _ in range(requests)])
+    return time.perf_counter() - started, latencies, 1 + pool.size
+
+
+def report(name, elapsed, latencies, threads):
+    latencies = sorted(latencies)
+    print(
+        "%-28s %7.2f s  %7.1f req/s  p50 %7.1f ms  p99 %7.1f ms  %3d threads"
+        % (
+            name,
+            elapsed,
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            threads,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=10)
+    args = parser.parse_args()
+
+    #  warm up the connections and the sqlite page cache
+    sync_call(time.perf_counter())
+    asyncio.run(measure_async(settings.ASYNC_DB_POOL_SIZE))
+
+    report(
+        "sync, %d threads" % args.threads, *measure_sync(args.requests, args.threads)
+    )
+    report(
+        "async, %d db threads" % settings.ASYNC_DB_POOL_SIZE,
+        *asyncio.run(measure_async(args.requests))
+    )
+    pool.close()
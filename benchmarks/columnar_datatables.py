@@ -0,0 +1,92 @@
+"""
+Zip code datatables calls, in-memory columnar engine vs SQLite
+
+Run from the folder that contains apps/:
+
+    python -m apps.simple_table.benchmarks.columnar_datatables --calls 50
+"""
+import argparse
+import time
+
+from ..common import db
+from ..controllers import (
+    zip_code_columnar,
+    zip_code_datatables_query,
+    zip_code_datatables_request,
+)
+from ..libs import columnar
+from ..models import zip_code_columns
+
+COLUMNS = ["DT_RowId", "zip_code", "zip_type", "state", "county", "primary_city"]
+
+
+def get_vars(search="", filters=None, order=None, start=0, length=15):
+    """
+    the vars datatables.net sends for the zip code datatable
+    """
+    filters = filters or dict()
+    vars = {
+        "draw": "1",
+        "start": str(start),
+        "length": str(length),
+        "search[value]": search,
+        "search[regex]": "false",
+    }
+    for number, name in enumerate(COLUMNS):
+        vars["columns[%d][data]" % number] = name
+        vars["columns[%d][name]" % number] = name
+        vars["columns[%d][search][value]" % number] = filters.get(name, "")
+    for number, (column, direction) in enumerate(order or []):
+        vars["order[%d][column]" % number] = str(column)
+        vars["order[%d][dir]" % number] = direction
+    return vars
+
+
+def sql(dtr):
+    query = zip_code_datatables_query(dtr)
+    db(db.zip_code.id > 0).count()
+    db(query).count()
+    db(query).select(
+        *dtr.dal_fields,
+        orderby=dtr.dal_orderby,
+        limitby=(dtr.start, dtr.start + dtr.length),
+        cacheable=True,
+    )
+
+
+def measure(call, dtr, calls):
+    call(dtr)
+    t0 = time.perf_counter()
+    for _ in range(calls):
+        call(dtr)
+    return (time.perf_counter() - t0) / calls * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=50)
+    args = parser.parse_args()
+
+    print("numpy: %s" % ("yes" if columnar.numpy is not None else "no, pure python"))
+    t0 = time.perf_counter()
+    zip_code_columns.current()
+    print("load: %.0f ms" % ((time.perf_counter() - t0) * 1000))
+
+    scenarios = [
+        ("first page", get_vars()),
+        ("page 1000", get_vars(start=15000)),
+        ("ordered by city", get_vars(order=[(5, "asc")], start=300)),
+        ("state filter", get_vars(filters=dict(state="WA"))),
+        ("search 'ity12'", get_vars("ity12")),
+        ("search + order", get_vars("Co", order=[(4, "desc")])),
+    ]
+    for name, vars in scenarios:
+        dtr = zip_code_datatables_request(vars)
+        print(
+            "%-18s columnar %8.2f ms/call   sql %8.2f ms/call"
+            % (
+                name,
+                measure(zip_code_columnar, dtr, args.calls),
+                measure(sql, dtr, args.calls),
+            )
+        )
@@ -0,0 +1,131 @@
+"""
+Grid table body, compiled renderer vs the py4web helper tree
+
+Run from the folder that contains apps/:
+
+    python -m apps.simple_table.benchmarks.grid_body --calls 20
+"""
+import argparse
+import io
+import time
+
+from py4web import request, response
+
+from ..common import db, GRID_DEFAULTS
+from ..libs.grid_helpers import CompiledTableBody
+from py4web.utils.grid import Grid
+from yatl.helpers import SPAN, I, XML
+
+
+def bind_request(path):
+    """
+    a GET of path for the Grid to read, as the py4web server would set it up
+    """
+    request.bind(
+        {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": path,
+            "QUERY_STRING": "",
+            "HTTP_HOST": "localhost",
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+            "CONTENT_LENGTH": "0",
+        }
+    )
+    response.bind()
+    request.app_name = "simple_table"
+
+
+def zip_code_grid(rows_per_page):
+    bind_request("/simple_table/zip_codes")
+    return Grid(
+        None,
+        db.zip_code.id > 0,
+        fields=[
+            db.zip_code.id,
+            db.zip_code.zip_code,
+            db.zip_code.zip_type,
+            db.zip_code.state,
+            db.zip_code.county,
+            db.zip_code.primary_city,
+        ],
+        orderby=[~db.zip_code.state, db.zip_code.county, db.zip_code.primary_city],
+        create=True,
+        details=True,
+        editable=True,
+        deletable=True,
+        auto_process=False,
+        **dict(GRID_DEFAULTS, rows_per_page=rows_per_page),
+    )
+
+
+def employee_grid(rows_per_page):
+    bind_request("/simple_table/employees")
+    grid = Grid(
+        None,
+        db.employee.id > 0,
+        field_id=db.employee.id,
+        fields=[
+            db.employee.id,
+            db.employee.fullname,
+            db.company.name,
+            db.department.name,
+            db.employee.hired,
+            db.employee.supervisor,
+            db.employee.active,
+        ],
+        left=[
+            db.company.on(db.employee.company == db.company.id),
+            db.department.on(db.employee.department == db.department.id),
+        ],
+        orderby=[db.employee.last_name, db.employee.first_name],
+        create=True,
+        details=True,
+        editable=True,
+        deletable=True,
+        auto_process=False,
+        **dict(GRID_DEFAULTS, rows_per_page=rows_per_page),
+    )
+    grid.formatters_by_type["boolean"] = (
+        lambda value: SPAN(I(_class="fas fa-check-circle")) if value else ""
+    )
+    grid.formatters_by_type["date"] = lambda value: (
+        XML('<time class="grid-date" datetime="%s">%s</time>' % (value, value))
+        if value
+        else ""
+    )
+    return grid
+
+
+def measure(render, calls):
+    render()
+    t0 = time.perf_counter()
+    for _ in range(calls):
+        render()
+    return (time.perf_counter() - t0) / calls * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20)
+    args = parser.parse_args()
+
+    for name, make in (("zip codes", zip_code_grid), ("employees", employee_grid)):
+        for rows_per_page in (15, 100, 1000):
+            grid = make(rows_per_page)
+            grid.process()
+            compiled = CompiledTableBody(grid)
+            body = compiled()
+            if not isinstance(body, XML):
+                print("%s: the grid renderer was used" % name)
+            elif body.xml() != grid.render_table_body().xml():
+                print("%s: the html differs" % name)
+            print(
+                "%-10s %4d rows   helpers %8.2f ms   compiled %8.2f ms"
+                % (
+                    name,
+                    len(grid.rows),
+                    measure(grid.render_table_body, args.calls),
+                    measure(compiled, args.calls),
+                )
+            )
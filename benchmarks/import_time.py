@@ -0,0 +1,62 @@
+"""
+Cold import time of the app - what every new worker pays before serving its first request
+
+Each run imports the app in a fresh interpreter, run from the folder that contains apps/:
+
+    python -m apps.simple_table.benchmarks.import_time --runs 10
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+APP_MODULE = __package__.rsplit(".", 1)[0]
+
+CODE = """
+import time
+t0 = time.perf_counter()
+import %s
+print(time.perf_counter() - t0)
+"""
+
+
+def measure(module, runs):
+    """
+    import module in runs fresh interpreters
+
+    :param module: dotted module name
+    :param runs: number of interpreters to start
+    :return: list of import times in seconds
+    """
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", CODE % module])
+        timings.append(float(output.decode().split()[-1]))
+    return timings
+
+
+def report(name, timings):
+    print(
+        "%-24s min %7.1f ms   median %7.1f ms   max %7.1f ms"
+        % (
+            name,
+            min(timings) * 1000,
+            statistics.median(timings) * 1000,
+            max(timings) * 1000,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    framework = measure("py4web", args.runs)
+    app = measure(APP_MODULE, args.runs)
+    report("py4web", framework)
+    report(APP_MODULE, app)
+    print(
+        "%-24s median %7.1f ms"
+        % ("app only", (statistics.median(app) - statistics.median(framework)) * 1000)
+    )
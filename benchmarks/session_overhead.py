@@ -0,0 +1,79 @@
+"""
+Per-call overhead of the session fixture for a read-only data call
+
+Runs the fixture on_request/on_success cycle outside of a server, from the folder that
+contains apps/:
+
+    python -m apps.simple_table.benchmarks.session_overhead --calls 5000
+"""
+import argparse
+import time
+
+from py4web import Session, request, response
+
+from ..libs.sessions import LazySession
+
+SECRET = "benchmark secret key"
+
+
+def bind(cookie=None):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/simple_table/datatables_data"}
+    if cookie:
+        environ["HTTP_COOKIE"] = cookie
+    request.bind(environ)
+    request.app_name = "simple_table"
+    response.bind()
+
+
+def make_cookie():
+    session = Session(secret=SECRET)
+    bind()
+    session.on_request()
+    session["user"] = dict(id=1)
+    session.on_success(200)
+    name = "simple_table_session"
+    return "%s=%s" % (name, response._cookies[name].value)
+
+
+def measure(session, cookie, calls, read):
+    """
+    time the fixture cycle of session
+
+    :param session: Session instance or None for no session fixture
+    :param cookie: Cookie header sent with every call
+    :param calls: number of calls
+    :param read: read the session like auth.get_user() does
+    :return: (microseconds per call, number of cookies signed)
+    """
+    signed = 0
+    elapsed = 0
+    for _ in range(calls):
+        bind(cookie)
+        t0 = time.perf_counter()
+        if session:
+            session.on_request()
+            if read:
+                session.get("user")
+            session.on_success(200)
+        elapsed += time.perf_counter() - t0
+        signed += len(response._cookies or ())
+    return elapsed / calls * 1e6, signed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+
+    cookie = make_cookie()
+    scenarios = [
+        ("Session, cookie", Session(secret=SECRET), cookie, False),
+        ("Session, no cookie", Session(secret=SECRET), None, False),
+        ("LazySession, cookie, unused", LazySession(secret=SECRET), cookie, False),
+        ("LazySession, cookie, read", LazySession(secret=SECRET), cookie, True),
+        ("LazySession, no cookie, read", LazySession(secret=SECRET), None, True),
+        ("no session fixture", None, cookie, False),
+    ]
+    for name, session, sent_cookie, read in scenarios:
+        per_call, signed = measure(session, sent_cookie, args.calls, read)
+        print("%-30s %8.1f us/call   %6d cookies signed" % (name, per_call, signed))
@@ -0,0 +1,79 @@
+"""
+Radius and nearest zip code searches, rtree + bounding box vs brute force scan
+
+Run migrate first so the rtree exists, then from the folder that contains apps/:
+
+    python -m apps.simple_table.benchmarks.spatial_search --searches 200 --radius 25
+"""
+import argparse
+import random
+import time
+
+from ..common import db
+from ..libs import geo
+from ..models import zip_code_locations
+
+
+def brute_force(latitude, longitude, radius):
+    """
+    the search without an index: read every row and compute all the distances
+
+    :return: list of (id, miles), nearest first
+    """
+    rows = db.executesql(
+        "SELECT id, latitude, longitude FROM zip_code "
+        "WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+    )
+    ids, latitudes, longitudes = zip(*rows)
+    miles = geo.distances(latitude, longitude, latitudes, longitudes)
+    return sorted(
+        [(id, m) for id, m in zip(ids, miles) if m <= radius], key=lambda x: x[1]
+    )
+
+
+def measure(search, points):
+    t0 = time.perf_counter()
+    found = 0
+    for latitude, longitude in points:
+        found += len(search(latitude, longitude))
+    return (time.perf_counter() - t0) / len(points) * 1000, found / len(points)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--searches", type=int, default=200)
+    parser.add_argument("--radius", type=float, default=25)
+    parser.add_argument("--count", type=int, default=10)
+    args = parser.parse_args()
+
+    min_lat, max_lat, min_lon, max_lon = db.executesql(
+        "SELECT min(latitude), max(latitude), min(longitude), max(longitude) "
+        "FROM zip_code"
+    )[0]
+    random.seed(0)
+    points = [
+        (random.uniform(min_lat, max_lat), random.uniform(min_lon, max_lon))
+        for _ in range(args.searches)
+    ]
+    print("numpy: %s" % ("yes" if geo.numpy is not None else "no, pure python"))
+
+    scenarios = [
+        (
+            "brute force, %g miles" % args.radius,
+            lambda lat, lon: brute_force(lat, lon, args.radius),
+            max(1, args.searches // 20),
+        ),
+        (
+            "rtree within, %g miles" % args.radius,
+            lambda lat, lon: zip_code_locations.within(lat, lon, args.radius),
+            args.searches,
+        ),
+        (
+            "rtree nearest %d" % args.count,
+            lambda lat, lon: zip_code_locations.nearest(lat, lon, args.count),
+            args.searches,
+        ),
+    ]
+    for name, search, searches in scenarios:
+        per_search, found = measure(search, points[:searches])
+        print("%-28s %9.2f ms/search   %7.1f rows" % (name, per_search, found))
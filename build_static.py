@@ -0,0 +1,15 @@
+"""
+Precompress the css and js of the app
+
+Writes a .gz (and a .br when brotli is installed) next to every file of static/css and
+static/js, served by the static_asset action.  Run once per deploy, from the folder that
+contains apps/:
+
+    python -m apps.simple_table.build_static
+"""
+from .common import static_assets
+
+if __name__ == "__main__":
+    for path in static_assets.build():
+        print(path)
+    print("static version %s" % static_assets.version())
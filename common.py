@@ -5,43 +5,104 @@ These are fixtures that every app needs so probably you will not be editing this
 import os
 import sys
 import logging
-from py4web import Session, Cache, Translator, DAL, Field, action
+from py4web import Translator, Field, action
 from py4web.utils.mailer import Mailer
 from py4web.utils.auth import Auth
 from py4web.utils.downloader import downloader
-from pydal.tools.tags import Tags
 from py4web.utils.factories import ActionFactory
 from py4web.utils.form import FormStyleDefault, FormStyleBulma
 from py4web.utils.grid import GridClassStyleBulma
 
 from . import settings
+from .libs.cache import SharedCache, MemoryStore, SQLiteStore, RedisStore
+from .libs.compression import Compress, StaticAssets
+from .libs.dal import DAL, LazyTags
+from .libs.logs import (
+    BufferedFileHandler,
+    BufferedStreamHandler,
+    JSONFormatter,
+    LogWriter,
+    RequestId,
+    RequestIdFilter,
+)
+from .libs.metrics import Metrics, QueryTimer, Timing
+from .libs.sessions import LazySession
 
 # implement custom loggers form settings.LOGGERS
 logger = logging.getLogger("py4web:" + settings.APP_NAME)
-formatter = logging.Formatter(
-    "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s"
-)
+if settings.LOG_FORMAT == "json":
+    formatter = JSONFormatter()
+else:
+    formatter = logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(request_id)s - %(filename)s:%(lineno)d - %(message)s"
+    )
 
+handlers = []
 for item in settings.LOGGERS:
     level, filename = item.split(":", 1)
     if filename in ("stdout", "stderr"):
-        handler = logging.StreamHandler(getattr(sys, filename))
+        stream = getattr(sys, filename)
+        if settings.LOG_QUEUE:
+            handler = BufferedStreamHandler(stream)
+        else:
+            handler = logging.StreamHandler(stream)
+    elif settings.LOG_QUEUE:
+        handler = BufferedFileHandler(filename)
     else:
         handler = logging.FileHandler(filename)
     handler.setLevel(getattr(logging, level.upper(), "ERROR"))
     handler.setFormatter(formatter)
+    handlers.append(handler)
+if handlers:
+    logger.setLevel(min(handler.level for handler in handlers))
+
+# the records are written by a background thread, the request threads only queue them
+log_writer = None
+if settings.LOG_QUEUE and handlers:
+    log_writer = LogWriter(
+        handlers, size=settings.LOG_QUEUE_SIZE, batch_size=settings.LOG_BATCH_SIZE
+    )
+    log_writer.start()
+    handlers = [log_writer.handler]
+
+for handler in handlers:
+    handler.addFilter(RequestIdFilter())
     logger.addHandler(handler)
 
-# connect to db
-db = DAL(settings.DB_URI, folder=settings.DB_FOLDER, pool_size=settings.DB_POOL_SIZE)
+# connect to db - the connection is opened by the first query and the tables are
+# defined the first time they are used, see migrate.py for the schema and indexes
+db = DAL(
+    settings.DB_URI,
+    folder=settings.DB_FOLDER,
+    pool_size=settings.DB_POOL_SIZE,
+    migrate=settings.DB_MIGRATE,
+    fake_migrate=settings.DB_FAKE_MIGRATE,
+    lazy_tables=settings.DB_LAZY_TABLES,
+)
 
 # define global objects that may or may not be used by th actions
-cache = Cache(size=1000)
 T = Translator(settings.T_FOLDER)
 
+# pick the cache store that suits you best
+if settings.CACHE_TYPE == "sqlite":
+    cache = SharedCache(
+        SQLiteStore(settings.CACHE_SQLITE_FILE, size=settings.CACHE_SIZE)
+    )
+elif settings.CACHE_TYPE == "redis":
+    import redis
+
+    host, port = settings.REDIS_SERVER.split(":")
+    cache = SharedCache(RedisStore(redis.Redis(host=host, port=int(port))))
+else:
+    cache = SharedCache(MemoryStore(size=settings.CACHE_SIZE))
+
+# the write generations of the tables move once the writes are committed
+db.after_commit(cache.commit)
+db.after_rollback(cache.rollback)
+
 # pick the session type that suits you best
 if settings.SESSION_TYPE == "cookies":
-    session = Session(secret=settings.SESSION_SECRET_KEY)
+    session = LazySession(secret=settings.SESSION_SECRET_KEY)
 elif settings.SESSION_TYPE == "redis":
     import redis
 
@@ -53,16 +114,16 @@ elif settings.SESSION_TYPE == "redis":
         if ct(k) >= 0
         else cs(k, v, e)
     )
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    session = LazySession(secret=settings.SESSION_SECRET_KEY, storage=conn)
 elif settings.SESSION_TYPE == "memcache":
     import memcache, time
 
     conn = memcache.Client(settings.MEMCACHE_CLIENTS, debug=0)
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    session = LazySession(secret=settings.SESSION_SECRET_KEY, storage=conn)
 elif settings.SESSION_TYPE == "database":
     from py4web.utils.dbstore import DBStore
 
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=DBStore(db))
+    session = LazySession(secret=settings.SESSION_SECRET_KEY, storage=DBStore(db))
 
 auth = Auth(session, db, define_tables=False)
 auth.use_username = True
@@ -83,7 +144,8 @@ if settings.SMTP_SERVER:
     )
 
 if auth.db:
-    groups = Tags(db.auth_user, "groups")
+    # the tables are defined on first use, the app does not touch the db at import
+    groups = LazyTags(db, "auth_user", "groups")
 
 if settings.USE_PAM:
     from py4web.utils.auth_plugins.pam_plugin import PamPlugin
@@ -149,6 +211,32 @@ auth.enable(uses=(session, T, db), env=dict(T=T))
 unauthenticated = ActionFactory(db, session, T, auth)
 authenticated = ActionFactory(db, session, T, auth.user)
 
+# compresses the output of the actions using it, list it after the template
+compress = Compress(
+    min_size=settings.COMPRESS_MIN_SIZE,
+    level=settings.COMPRESS_LEVEL,
+    cache=cache,
+    expiration=settings.GRID_FRAGMENT_CACHE_EXPIRATION,
+    enabled=settings.COMPRESS_RESPONSES,
+)
+static_assets = StaticAssets(os.path.join(os.path.dirname(__file__), "static"))
+
+# gives every request its id (X-Request-ID), the actions using timing get it
+request_ids = RequestId()
+
+# times the phases of the actions using it, list it first and timing.end last
+metrics = Metrics(prefix=settings.APP_NAME, buckets=settings.REQUEST_TIMING_BUCKETS)
+timing = Timing(metrics, enabled=settings.REQUEST_TIMING, prerequisites=[request_ids])
+if settings.REQUEST_TIMING:
+    db._adapter.execution_handlers.append(QueryTimer)
+
+# fixtures for anonymous read-only data calls like datatables_data, skipping the session
+# and auth spares them the cookie decoding and the auth_user lookup
+if settings.READ_ONLY_SKIP_SESSION:
+    READ_ONLY_FIXTURES = (timing, db, compress, timing.end)
+else:
+    READ_ONLY_FIXTURES = (timing, session, db, auth, compress, timing.end)
+
 GRID_DEFAULTS = dict(
     rows_per_page=15,
     include_action_button_text=True,
@@ -1,34 +1,315 @@
+import hashlib
+import hmac
 import json
+import math
+from array import array
 from functools import reduce
 from yatl.helpers import SPAN, I, XML
 
-from py4web import action, request, redirect, URL, Field
+from py4web import action, request, response, redirect, abort, URL, Field
 from py4web.utils.form import Form, FormStyleBulma, FormStyleDefault
-from pydal.validators import IS_NULL_OR, IS_IN_SET
-from .common import db, session, auth, unauthenticated, GRID_DEFAULTS
-from .libs.datatables import DataTablesField, DataTablesRequest, DataTablesResponse
-from .libs.grid_helpers import GridSearch, GridSearchQuery
+from pydal.validators import IS_IN_SET
+from . import settings
+from .common import (
+    db,
+    session,
+    auth,
+    cache,
+    compress,
+    static_assets,
+    logger,
+    log_writer,
+    metrics,
+    timing,
+    unauthenticated,
+    GRID_DEFAULTS,
+    READ_ONLY_FIXTURES,
+)
+from .models import (
+    backfill_employee_fullname,
+    change_log,
+    zip_code_columns,
+    zip_code_locations,
+)
+from .libs.datatables import (
+    DataTablesField,
+    DataTablesRequest,
+    DataTablesResponse,
+    DrawTracker,
+)
+from .libs.async_db import ReadPool
+from .libs.cache import SingleFlight
+from .libs.statements import StatementCache, like_pattern
+from .libs.metrics import phase
+from .libs.interrupt import QueryInterrupted, interruptible
+from .libs.validators import IS_IN_DB_LOOKUP
+from .libs.widgets import LookupWidget
+from .libs.grid_helpers import (
+    CompiledTableBody,
+    GridSearch,
+    GridSearchQuery,
+    LazyGrid,
+)
 from py4web.utils.grid import Grid
 
 
 @action("index", method=["POST", "GET"])
 @action.uses(
+    timing,
     "index.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def index():
     return dict()
 
 
+def distinct_values(field):
+    """
+    sorted distinct values of a field, cached until the table is written to
+
+    :param field: pydal Field
+    :return: list of values
+    """
+    return cache.get(
+        "distinct:%s:%s" % (field, cache.generation(field.tablename)),
+        lambda: [
+            row[field.name]
+            for row in db(field.table.id > 0).select(
+                field, orderby=field, distinct=True
+            )
+        ],
+        settings.GRID_LOOKUP_CACHE_EXPIRATION,
+    )
+
+
+def lazy_grid(grid, *tables):
+    if settings.GRID_COMPILED_BODY:
+        grid.render_table_body = CompiledTableBody(grid)
+    return LazyGrid(
+        grid,
+        cache=cache,
+        expiration=settings.GRID_FRAGMENT_CACHE_EXPIRATION,
+        generation=lambda: tuple(
+            cache.generation(table._tablename) for table in tables
+        ),
+        enabled=settings.GRID_LAZY_LOAD,
+        compress=compress,
+    )
+
+
+#  bounds of the radius searches, the zip codes a grid search or near_zip_codes returns
+NEAR_MAX_RADIUS = 250  # miles
+NEAR_MAX_COUNT = 100
+NEAR_MAX_ROWS = 1000
+
+
+def finite(value):
+    """
+    :param value: text of a number
+    :return: float
+    :raises ValueError: when it is not a number or not finite (nan, inf)
+    """
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError("not a finite number: %r" % value)
+    return number
+
+
+def zip_code_location(zip_code):
+    """
+    :param zip_code: the zip code
+    :return: (latitude, longitude) or None when unknown
+    """
+    #  the stored values, like the spatial index, not rounded to the decimal(5,2) type
+    rows = db.executesql(
+        db(db.zip_code.zip_code == zip_code)._select(
+            db.zip_code.latitude, db.zip_code.longitude
+        )
+    )
+    if not rows or None in rows[0]:
+        return None
+    return float(rows[0][0]), float(rows[0][1])
+
+
+def near_zip_code_query(value):
+    """
+    grid search for the zip codes within a radius of a zip code
+
+    :param value: "zip code" or "zip code,miles", 25 miles by default, NEAR_MAX_RADIUS
+                  at most
+    :return: dal query
+    """
+    zip_code, _, miles = value.partition(",")
+    location = zip_code_location(zip_code.strip())
+    try:
+        miles = finite(miles) if miles.strip() else 25
+    except ValueError:
+        miles = 25
+    miles = min(max(miles, 0), NEAR_MAX_RADIUS)
+    ids = (
+        [
+            id
+            for id, _ in zip_code_locations.within(
+                *location, miles, limit=NEAR_MAX_ROWS
+            )
+        ]
+        if location
+        else []
+    )
+    return db.zip_code.id.belongs(ids)
+
+
+@action("near_zip_codes", method=["GET"])
+@action.uses(*READ_ONLY_FIXTURES)
+def near_zip_codes():
+    """
+    the zip codes nearest to a zip code or a point, nearest first
+
+    ?zip_code=... or ?latitude=...&longitude=...
+    then ?count=... (default 10, NEAR_MAX_COUNT at most) for the nearest or ?radius=...
+    for the nearest NEAR_MAX_ROWS within radius miles (NEAR_MAX_RADIUS at most)
+
+    :return: json list of zip_code, primary_city, state and miles
+    """
+    try:
+        if request.query.get("zip_code"):
+            location = zip_code_location(request.query.get("zip_code"))
+            if not location:
+                abort(404, "unknown zip code")
+        else:
+            location = (
+                finite(request.query.get("latitude")),
+                finite(request.query.get("longitude")),
+            )
+            if abs(location[0]) > 90 or abs(location[1]) > 180:
+                raise ValueError("not a point: %r" % (location,))
+        if request.query.get("radius"):
+            radius = min(max(finite(request.query.get("radius")), 0), NEAR_MAX_RADIUS)
+            count = None
+        else:
+            count = min(max(int(request.query.get("count", 10)), 1), NEAR_MAX_COUNT)
+    except (TypeError, ValueError):
+        abort(400, "zip_code or latitude and longitude required, finite numbers")
+
+    if count is None:
+        found = zip_code_locations.within(*location, radius, limit=NEAR_MAX_ROWS)
+    else:
+        found = zip_code_locations.nearest(*location, count=count)
+
+    miles = dict(found)
+    rows = db(db.zip_code.id.belongs(list(miles))).select(
+        db.zip_code.id,
+        db.zip_code.zip_code,
+        db.zip_code.primary_city,
+        db.zip_code.state,
+    )
+    data = [
+        dict(
+            zip_code=row.zip_code,
+            primary_city=row.primary_city,
+            state=row.state,
+            miles=round(miles[row.id], 2),
+        )
+        for row in rows
+    ]
+    data.sort(key=lambda x: x["miles"])
+    return json.dumps(data)
+
+
+@action("lookup/<tablename>/<fieldname>", method=["GET"])
+@action.uses(*READ_ONLY_FIXTURES)
+def lookup(tablename, fieldname):
+    """
+    typeahead data for a field validated by IS_IN_DB_LOOKUP, see LookupWidget
+
+    ?q=... the typed text, ?page=... from 0
+
+    :return: json results (id and label) and more (true when there is a next page)
+    """
+    if tablename not in db.tables or fieldname not in db[tablename].fields:
+        abort(404)
+    requires = db[tablename][fieldname].requires
+    validator = getattr(requires, "other", requires)
+    if not isinstance(validator, IS_IN_DB_LOOKUP):
+        abort(404)
+    try:
+        page = max(0, int(request.query.get("page", 0)))
+    except ValueError:
+        abort(400, "page must be a number")
+
+    options, more = validator.lookup(request.query.get("q", ""), page)
+    return json.dumps(
+        dict(results=[dict(id=id, label=label) for id, label in options], more=more)
+    )
+
+
+@action("changes/<tablename>", method=["GET"])
+@action.uses(*READ_ONLY_FIXTURES)
+def changes(tablename):
+    """
+    the rows of a table changed since a version, for clients keeping a copy of it
+
+    without ?since=... only the current version is returned, read it before the data.
+    then ?since=<version>&limit=... (default 1000) returns the inserted and updated rows,
+    the deleted ids and the version to ask from next time.  when more is true ask again
+    right away, when reset is true read all the data again
+
+    the rows have the id and the fields of change_log.fields, the ones the grids show
+
+    :return: json version, reset, more, inserted, updated, deleted
+    """
+    if tablename not in change_log.tablenames:
+        abort(404)
+    if not change_log.exists():
+        abort(503, "the change log is created by migrate.py (sqlite only)")
+    if request.query.get("since") is None:
+        return json.dumps(dict(version=change_log.version()))
+    try:
+        since = int(request.query.get("since"))
+        limit = min(5000, max(1, int(request.query.get("limit", 1000))))
+    except ValueError:
+        abort(400, "since and limit must be numbers")
+
+    result = change_log.changes(tablename, since, limit)
+    table = db[tablename]
+    ids = result["inserted"] + result["updated"]
+    fields = [table._id] + [table[name] for name in change_log.fields[tablename]]
+    rows = {row.id: row.as_dict() for row in db(table._id.belongs(ids)).select(*fields)}
+    for key in ("inserted", "updated"):
+        #  rows deleted after the changes read are deleted for the client too
+        result["deleted"] += [id for id in result[key] if id not in rows]
+        result[key] = [rows[id] for id in result[key] if id in rows]
+    return json.dumps(result, default=str)
+
+
+@action(
+    "static/_<version:re:\\d+\\.\\d+\\.\\d+>/<path:re:(?:css|js)/.+>", method=["GET"]
+)
+def static_asset(version, path):
+    """
+    the css and js of the app, precompressed and cached for a year, see StaticAssets
+
+    registered before the static route of py4web, which serves the other static files
+
+    :return:
+    """
+    return static_assets.serve(path, version)
+
+
 @action("zip_codes", method=["POST", "GET"])
 @action("zip_codes/<path:path>", method=["POST", "GET"])
 @action.uses(
+    timing,
     "grid.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def zip_codes(path=None):
     fields = [
@@ -41,37 +322,22 @@ def zip_codes(path=None):
     ]
 
     #  build the search form
-    zip_type_requires = IS_NULL_OR(
-        IS_IN_SET(
-            [
-                x.zip_type
-                for x in db(db.zip_code.id > 0).select(
-                    db.zip_code.zip_type, orderby=db.zip_code.zip_type, distinct=True
-                )
-            ]
-        )
-    )
-    zip_state_requires = IS_NULL_OR(
-        IS_IN_SET(
-            [
-                x.state
-                for x in db(db.zip_code.id > 0).select(
-                    db.zip_code.state, orderby=db.zip_code.state, distinct=True
-                )
-            ]
-        )
-    )
     queries = [(db.zip_code.id > 0)]
 
     orderby = [~db.zip_code.state, db.zip_code.county, db.zip_code.primary_city]
 
     search_queries = [
         GridSearchQuery(
-            "Search by State", lambda val: db.zip_code.state == val, zip_state_requires
+            "Search by State",
+            lambda val: db.zip_code.state == val,
+            facet=db.zip_code.state,
         ),
         GridSearchQuery(
-            "Search by Type", lambda val: db.zip_code.zip_type == val, zip_type_requires
+            "Search by Type",
+            lambda val: db.zip_code.zip_type == val,
+            facet=db.zip_code.zip_type,
         ),
+        GridSearchQuery("Near Zip Code", near_zip_code_query),
         GridSearchQuery(
             "Search by Name",
             lambda val: db.zip_code.zip_code.contains(val)
@@ -82,29 +348,13 @@ def zip_codes(path=None):
         ),
     ]
 
-    search = GridSearch(search_queries, queries)
-
-    zip_type_requires = IS_IN_SET(
-        [
-            x.zip_type
-            for x in db(db.zip_code.id > 0).select(
-                db.zip_code.zip_type, orderby=db.zip_code.zip_type, distinct=True
-            )
-        ]
-    )
-    zip_state_requires = IS_IN_SET(
-        [
-            x.state
-            for x in db(db.zip_code.id > 0).select(
-                db.zip_code.state, orderby=db.zip_code.state, distinct=True
-            )
-        ]
-    )
-    zip_timezone_requires = IS_IN_SET(
-        [
-            x.timezone
-            for x in db(db.zip_code.id > 0).select(db.zip_code.timezone, distinct=True)
-        ]
+    #  the state and type options show their counts under the other searches
+    search = GridSearch(
+        search_queries,
+        queries,
+        cache=cache,
+        generation=cache.generation("zip_code"),
+        expiration=settings.GRID_LOOKUP_CACHE_EXPIRATION,
     )
 
     grid = Grid(
@@ -117,19 +367,49 @@ def zip_codes(path=None):
         details=True,
         editable=True,
         deletable=True,
-        **GRID_DEFAULTS
+        auto_process=False,
+        **GRID_DEFAULTS,
     )
 
+    grid = lazy_grid(grid, db.zip_code)
+    if grid.fragment:
+        return grid.render()
+
     return dict(grid=grid)
 
 
+#  the columns searched by the search box of the datatable
+ZIP_CODE_SEARCH_FIELDS = ["primary_city", "zip_code", "zip_type", "state", "county"]
+
+#  the columns shown by the datatable, also the columns datatables_data selects
+ZIP_CODE_DATATABLES_FIELDS = [
+    DataTablesField(name="DT_RowId", visible=False),
+    DataTablesField(name="zip_code", search_type="startswith"),
+    DataTablesField(
+        name="zip_type",
+        search_type="equals",
+        options=lambda: distinct_values(db.zip_code.zip_type),
+    ),
+    DataTablesField(
+        name="state",
+        search_type="equals",
+        options=lambda: distinct_values(db.zip_code.state),
+    ),
+    DataTablesField(name="county"),
+    DataTablesField(name="primary_city"),
+]
+
+
 @unauthenticated
 @action("datatables", method=["GET", "POST"])
 @action.uses(
+    timing,
     "datatables.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def datatables():
     """
@@ -138,97 +418,483 @@ def datatables():
     :return:
     """
     dt = DataTablesResponse(
-        fields=[
-            DataTablesField(name="DT_RowId", visible=False),
-            DataTablesField(name="zip_code"),
-            DataTablesField(name="zip_type"),
-            DataTablesField(name="state"),
-            DataTablesField(name="county"),
-            DataTablesField(name="primary_city"),
-        ],
+        fields=ZIP_CODE_DATATABLES_FIELDS,
         data_url=URL("datatables_data"),
         create_url=URL("zip_code/0"),
         edit_url=URL("zip_code/record_id"),
         delete_url=URL("zip_code/delete/record_id"),
         sort_sequence=[[1, "asc"]],
+        pipeline_pages=settings.DATATABLES_PIPELINE_PAGES,
+        pipeline_max_age=settings.DATATABLES_PIPELINE_MAX_AGE,
     )
+    if settings.DATATABLES_EMBED_FIRST_PAGE:
+        #  the first draw, from the saved state of the table, goes out with the page
+        vars = dt.first_draw_vars(request.get_cookie(dt.state_cookie))
+        dtr = zip_code_datatables_request(vars)
+        if 0 < dtr.length <= 100:
+            version = cache.generation("zip_code")
+            response = zip_code_columnar(dtr)
+            try:
+                if response is None:
+                    response = zip_code_sql(
+                        dtr, budget=settings.DATATABLES_QUERY_BUDGET
+                    )
+                dt.embed(vars, dict(response, version=version))
+            except QueryInterrupted:
+                #  the browser asks for it
+                pass
     dt.script()
     return dict(dt=dt)
 
 
-@action("datatables_data", method=["GET", "POST"])
-@action.uses(session, db, auth)
-def datatables_data():
+def zip_code_datatables_request(get_vars):
     """
-    datatables.net makes an ajax call to this method to get the data
+    parse a datatables.net data call for the zip code datatable
 
-    :return:
+    shared by datatables_data and the async endpoint in asgi.py
+
+    :param get_vars: vars supplied by datatables.net
+    :return: DataTablesRequest with the orderby and the columns to select
     """
-    dtr = DataTablesRequest(dict(request.query.decode()))
+    dtr = DataTablesRequest(get_vars)
     dtr.order(db, "zip_code")
+    #  ties broken by id, the same as zip_code_columnar, pages never overlap or skip rows
+    dtr.dal_orderby.append(db.zip_code.id)
+    dtr.project(db, "zip_code", ZIP_CODE_DATATABLES_FIELDS)
+    dtr.filter(db, "zip_code", ZIP_CODE_DATATABLES_FIELDS)
+    return dtr
 
-    queries = [(db.zip_code.id > 0)]
+
+def zip_code_datatables_query(dtr):
+    """
+    the zip code query for a datatables.net data call, with the column filters and the
+    search box applied
+
+    :param dtr: DataTablesRequest
+    :return: dal query
+    """
+    queries = [(db.zip_code.id > 0)] + dtr.dal_filters
     if dtr.search_value and dtr.search_value != "":
         queries.append(
-            (db.zip_code.primary_city.contains(dtr.search_value))
-            | (db.zip_code.zip_code.contains(dtr.search_value))
-            | (db.zip_code.zip_type.contains(dtr.search_value))
-            | (db.zip_code.state.contains(dtr.search_value))
-            | (db.zip_code.county.contains(dtr.search_value))
+            reduce(
+                lambda a, b: (a | b),
+                [
+                    db.zip_code[name].contains(dtr.search_value)
+                    for name in ZIP_CODE_SEARCH_FIELDS
+                ],
+            )
         )
 
-    query = reduce(lambda a, b: (a & b), queries)
-    record_count = db(db.zip_code.id > 0).count()
-    filtered_count = db(query).count()
+    return reduce(lambda a, b: (a & b), queries)
 
-    data = [
-        dict(
-            DT_RowId=z.id,
-            zip_code=z.zip_code,
-            zip_type=z.zip_type,
-            state=z.state,
-            county=z.county,
-            primary_city=z.primary_city,
+
+statements = StatementCache(db, size=settings.STATEMENT_CACHE_SIZE)
+
+COMPARISONS = {
+    "=": lambda field, value: field == value,
+    ">=": lambda field, value: field >= value,
+    "<": lambda field, value: field < value,
+    "<=": lambda field, value: field <= value,
+}
+
+
+def zip_code_statements(dtr):
+    """
+    the sql of a datatables.net data call: the total count, the page and, when the call is
+    filtered, the filtered count
+
+    with DATATABLES_COMPILED_STATEMENTS the sql comes from statements, compiled once for
+    the shape of the call (filters, search, order and columns), and the values are bound.
+    the same as zip_code_datatables_query, but no query is built past the first call
+
+    :param dtr: DataTablesRequest
+    :return: list of (sql, values to bind)
+    """
+    filtered = bool(dtr.search_value or dtr.dal_filters)
+    if not (settings.DATATABLES_COMPILED_STATEMENTS and statements.enabled):
+        query = zip_code_datatables_query(dtr)
+        sql = [
+            (db(db.zip_code.id > 0)._count(), None),
+            (
+                db(query)._select(
+                    *dtr.dal_fields,
+                    orderby=dtr.dal_orderby,
+                    limitby=[dtr.start, dtr.start + dtr.length],
+                ),
+                None,
+            ),
+        ]
+        if filtered:
+            sql.append((db(query)._count(), None))
+        return sql
+
+    def build():
+        table = db.zip_code
+        parameter = statements.parameter
+        queries = [table.id > 0] + [
+            COMPARISONS[operator](table[name], parameter)
+            for name, operator, _ in dtr.filter_predicates
+        ]
+        if dtr.search_value:
+            queries.append(
+                reduce(
+                    lambda a, b: (a | b),
+                    [
+                        table[name].lower().like(parameter, escape="\\")
+                        for name in ZIP_CODE_SEARCH_FIELDS
+                    ],
+                )
+            )
+        query = reduce(lambda a, b: (a & b), queries)
+        return (
+            db(table.id > 0)._count(),
+            statements.limit(
+                db(query)._select(*dtr.dal_fields, orderby=dtr.dal_orderby)
+            ),
+            db(query)._count(),
         )
-        for z in db(query).select(
-            orderby=dtr.dal_orderby, limitby=[dtr.start, dtr.start + dtr.length]
+
+    total, page, count = statements.get(
+        (
+            "datatables:zip_code",
+            tuple(dtr.field_names),
+            tuple(dtr.order_columns),
+            tuple((name, operator) for name, operator, _ in dtr.filter_predicates),
+            bool(dtr.search_value),
+        ),
+        build,
+    )
+    values = [value for _, _, value in dtr.filter_predicates]
+    if dtr.search_value:
+        values += [like_pattern(dtr.search_value)] * len(ZIP_CODE_SEARCH_FIELDS)
+    sql = [(total, []), (page, values + [dtr.length, dtr.start])]
+    if filtered:
+        sql.append((count, values))
+    return sql
+
+
+def zip_code_data_version():
+    """
+    the version of the zip codes for the results kept in the cache
+
+    the zip_code generation moves with the commits of the dal writes.  once migrate
+    created the change log its version is added, it moves with any write to the logged
+    tables, raw sql too.  without the log the writes made outside the dal (executesql,
+    other programs) are only seen when the kept results expire
+
+    :return: "<generation>" or "<generation>.<change log version>"
+    """
+    version = "%s" % cache.generation("zip_code")
+    if change_log.exists():
+        version += ".%s" % change_log.version()
+    return version
+
+
+def zip_code_snapshot(dtr):
+    """
+    the ordered ids of a filtered search, selected once and kept in the cache under the
+    cursor of the request and the version of the data (zip_code_data_version) until it
+    expires or zip_code is written to
+
+    :param dtr: DataTablesRequest
+    :return: array of ids, None when the request is not filtered or the result too big
+    """
+    if not settings.DATATABLES_SNAPSHOTS or not (dtr.search_value or dtr.dal_filters):
+        return None
+
+    def select():
+        query = zip_code_datatables_query(dtr)
+        ids = array(
+            "L",
+            (
+                row[0]
+                for row in db.executesql(
+                    db(query)._select(
+                        db.zip_code.id,
+                        orderby=dtr.dal_orderby,
+                        limitby=(0, settings.DATATABLES_SNAPSHOT_MAX_ROWS + 1),
+                    )
+                )
+            ),
         )
-    ]
+        return ids if len(ids) <= settings.DATATABLES_SNAPSHOT_MAX_ROWS else None
 
-    return json.dumps(
-        dict(data=data, recordsTotal=record_count, recordsFiltered=filtered_count)
+    return cache.get(
+        "cursor:%s:%s" % (dtr.cursor(), zip_code_data_version()),
+        select,
+        settings.DATATABLES_SNAPSHOT_EXPIRATION,
     )
 
 
+def zip_code_columnar(dtr):
+    """
+    answer a datatables.net data call from the in-memory zip_code_columns
+
+    ties in the order are broken by id
+
+    :param dtr: DataTablesRequest
+    :return: the response dict, None when the engine is off or a filter or the order is
+             not one it supports (range filters), the call then goes to the database
+    """
+    if not settings.DATATABLES_COLUMNAR:
+        return None
+    if any(search_type == "range" for _, search_type, _ in dtr.filter_values):
+        return None
+    if not zip_code_columns.supports(
+        [name for name, _ in dtr.order_columns]
+        + [name for name, _, _ in dtr.filter_values]
+    ):
+        return None
+
+    record_count, filtered_count, rows = zip_code_columns.query(
+        dtr.filter_values,
+        dtr.search_value,
+        ZIP_CODE_SEARCH_FIELDS,
+        dtr.order_columns + [("id", False)],
+        dtr.start,
+        dtr.length,
+    )
+    return dict(
+        data=[
+            {
+                name: row["id" if name == "DT_RowId" else name]
+                for name in dtr.field_names
+            }
+            for row in rows
+        ],
+        recordsTotal=record_count,
+        recordsFiltered=filtered_count,
+    )
+
+
+read_pool = ReadPool(db, size=settings.DATATABLES_READ_POOL_SIZE)
+
+
+def zip_code_parallel(dtr, budget=None, cancelled=None):
+    """
+    the counts and the page of a datatables.net data call, run at the same time on
+    read_pool connections
+
+    the change_log version tells whether they all read the same data, call it only once
+    change_log.exists(): before migrate created the log every snapshot reads the same
+    empty version whatever was written in between
+
+    :param dtr: DataTablesRequest
+    :return: the response dict, None when a write happened between the queries
+    """
+    results = read_pool.read(
+        zip_code_statements(dtr),
+        change_log.version_sql(),
+        budget=budget,
+        cancelled=cancelled,
+    )
+    if results is None:
+        return None
+    return zip_code_results(dtr, results)
+
+
+def zip_code_results(dtr, results):
+    """
+    the response dict of a datatables.net data call from the results of its
+    zip_code_statements
+
+    :param dtr: DataTablesRequest
+    :param results: list of the rows of each statement, in their order
+    :return: the response dict
+    """
+    total, rows = results[0][0][0], results[1]
+    return dict(
+        data=[dict(zip(dtr.field_names, row)) for row in rows],
+        recordsTotal=total,
+        recordsFiltered=results[2][0][0] if len(results) > 2 else total,
+    )
+
+
+def zip_code_sql(dtr, budget=None, cancelled=None):
+    """
+    answer a datatables.net data call from the database
+
+    with DATATABLES_PARALLEL_QUERIES the queries run at the same time on pooled
+    connections, except for the snapshot of a filtered search and until migrate created
+    the change log.  without a search the filtered count is the total count
+
+    :param dtr: DataTablesRequest
+    :param budget: seconds the queries may run, see libs/interrupt.py
+    :param cancelled: function, True when the draw was superseded
+    :return: the response dict
+    """
+    filtered = bool(dtr.search_value or dtr.dal_filters)
+    if (
+        settings.DATATABLES_PARALLEL_QUERIES
+        and not (filtered and settings.DATATABLES_SNAPSHOTS)
+        and change_log.exists()
+    ):
+        response = zip_code_parallel(dtr, budget, cancelled)
+        if response is not None:
+            return response
+
+    with interruptible(db, budget=budget, cancelled=cancelled):
+        sql = zip_code_statements(dtr)
+        record_count = db.executesql(*sql[0])[0][0]
+
+        ids = zip_code_snapshot(dtr)
+        if ids is None:
+            data = [dict(zip(dtr.field_names, row)) for row in db.executesql(*sql[1])]
+            filtered_count = db.executesql(*sql[2])[0][0] if filtered else record_count
+        else:
+            filtered_count = len(ids)
+            #  datatables sends -1 for all the rows
+            page = ids[dtr.start : dtr.start + dtr.length if dtr.length >= 0 else None]
+            position = {id: index for index, id in enumerate(page)}
+            data = dtr.data(
+                db(db.zip_code.id.belongs(page))
+                .select(*dtr.dal_fields, cacheable=True)
+                .sort(lambda row: position[row.id])
+            )
+
+    return dict(
+        data=data,
+        recordsTotal=record_count,
+        recordsFiltered=filtered_count,
+    )
+
+
+flights = SingleFlight()
+
+
+def zip_code_single_flight(dtr, func):
+    """
+    run func once for the concurrent data calls asking for the same page of the same
+    search, the others wait and share its response
+
+    the key holds the zip_code generation, a call made after a write never gets the
+    response of a query started before it.  a call cancelled because its draw was
+    superseded does not cancel the calls waiting on it, they query again
+
+    :param dtr: DataTablesRequest
+    :param func: function returning the response dict
+    :return: the response dict, shared - do not change it
+    """
+    if not settings.DATATABLES_SINGLE_FLIGHT:
+        return func()
+    return flights.do(
+        "datatables:%s:%s:%s:%s"
+        % (dtr.cursor(), dtr.start, dtr.length, cache.generation("zip_code")),
+        func,
+        share_error=lambda e: getattr(e, "reason", None) != "cancelled",
+    )
+
+
+draws = DrawTracker(cache.store)
+
+
+def draw_key(dtr):
+    """
+    the key of a datatable in draws: the session cookie and the page_id sent by the table
+
+    the cookie is hashed as it comes, it is neither decoded nor signed again.  without a
+    cookie the page_id alone tells the tables apart, calls without a page_id are not
+    tracked: they would all share one key and cancel the queries of each other
+
+    :param dtr: DataTablesRequest
+    :return: "draw:<sha1>"
+    """
+    cookie = request.get_cookie("%s_session" % request.app_name) or ""
+    return (
+        "draw:%s" % hashlib.sha1(("%s:%s" % (cookie, dtr.page_id)).encode()).hexdigest()
+    )
+
+
+@action("datatables_data", method=["GET", "POST"])
+@action.uses(*READ_ONLY_FIXTURES)
+def datatables_data():
+    """
+    datatables.net makes an ajax call to this method to get the data
+
+    the draw is echoed so the browser can drop responses that arrive out of order, and
+    the version of the table so it can drop the pages it kept from before a write.  the
+    queries of a draw stop when the same table sent a newer one (the response is dropped
+    anyway) or when they run past DATATABLES_QUERY_BUDGET
+
+    :return:
+    """
+    dtr = zip_code_datatables_request(dict(request.query.decode()))
+    #  read before the data, the pages kept by the browser are dropped when it changes
+    version = cache.generation("zip_code")
+    cancelled = None
+    if dtr.draw is not None and dtr.page_id and settings.DATATABLES_CANCEL_SUPERSEDED:
+        key = draw_key(dtr)
+        draws.start(key, dtr.draw)
+        cancelled = lambda: draws.superseded(key, dtr.draw)
+
+    response = zip_code_columnar(dtr)
+    if response is None:
+        try:
+            response = zip_code_single_flight(
+                dtr,
+                lambda: zip_code_sql(
+                    dtr, budget=settings.DATATABLES_QUERY_BUDGET, cancelled=cancelled
+                ),
+            )
+        except QueryInterrupted as e:
+            response = zip_code_interrupted(dtr, e)
+
+    return zip_code_data_json(dtr, response, version)
+
+
+def zip_code_interrupted(dtr, e):
+    """
+    the response of a datatables.net data call whose queries were stopped, it is not a
+    result and the browser does not keep it
+
+    :param dtr: DataTablesRequest
+    :param e: QueryInterrupted
+    :return: the response dict
+    """
+    response = dict(data=[], recordsTotal=0, recordsFiltered=0, interrupted=e.reason)
+    if e.reason == "budget":
+        logger.warning(
+            "datatables search stopped after %ss: %r",
+            settings.DATATABLES_QUERY_BUDGET,
+            dtr.search_value,
+        )
+        response["error"] = (
+            "The search took too long, "
+            "add characters or use the column filters to narrow it"
+        )
+    return response
+
+
+def zip_code_data_json(dtr, response, version):
+    """
+    the json of a datatables.net data call, shared by datatables_data and asgi.py
+
+    :param dtr: DataTablesRequest
+    :param response: the response dict, shared with concurrent calls - not changed
+    :param version: cache.generation("zip_code") read before the data
+    :return: json with the draw and the version
+    """
+    with phase("serialize"):
+        return json.dumps(dict(response, draw=dtr.draw, version=version))
+
+
 @action("zip_code/<zip_code_id>", method=["GET", "POST"])
 @action.uses(
+    timing,
     "edit.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def zip_code(zip_code_id):
     db.zip_code.id.readable = False
     db.zip_code.id.writable = False
 
-    db.zip_code.zip_type.requires = IS_IN_SET(
-        [
-            x.zip_type
-            for x in db(db.zip_code.id > 0).select(db.zip_code.zip_type, distinct=True)
-        ]
-    )
-    db.zip_code.state.requires = IS_IN_SET(
-        [
-            x.state
-            for x in db(db.zip_code.id > 0).select(db.zip_code.state, distinct=True)
-        ]
-    )
-    db.zip_code.timezone.requires = IS_IN_SET(
-        [
-            x.timezone
-            for x in db(db.zip_code.id > 0).select(db.zip_code.timezone, distinct=True)
-        ]
-    )
+    db.zip_code.zip_type.requires = IS_IN_SET(distinct_values(db.zip_code.zip_type))
+    db.zip_code.state.requires = IS_IN_SET(distinct_values(db.zip_code.state))
+    db.zip_code.timezone.requires = IS_IN_SET(distinct_values(db.zip_code.timezone))
 
     form = Form(db.zip_code, record=zip_code_id, formstyle=FormStyleBulma)
 
@@ -240,10 +906,13 @@ def zip_code(zip_code_id):
 
 @action("zip_code/delete/<zip_code_id>", method=["GET", "POST"])
 @action.uses(
+    timing,
     "grid.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def zip_code_delete(zip_code_id):
     result = db(db.zip_code.id == zip_code_id).delete()
@@ -277,10 +946,13 @@ def FormStyleGrid(table, vars, errors, readonly, deletable):
 @action("companies", method=["POST", "GET"])
 @action("companies/<path:path>", method=["POST", "GET"])
 @action.uses(
+    timing,
     "grid.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def companies(path=None):
     queries = [(db.company.id > 0)]
@@ -298,7 +970,7 @@ def companies(path=None):
         details=True,
         editable=True,
         deletable=True,
-        **GRID_DEFAULTS
+        **GRID_DEFAULTS,
     )
 
     return dict(grid=grid)
@@ -307,10 +979,13 @@ def companies(path=None):
 @action("departments", method=["POST", "GET"])
 @action("departments/<path:path>", method=["POST", "GET"])
 @action.uses(
+    timing,
     "grid.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def departments(path=None):
     queries = [(db.department.id > 0)]
@@ -330,22 +1005,48 @@ def departments(path=None):
         details=True,
         editable=True,
         deletable=True,
-        **GRID_DEFAULTS
+        **GRID_DEFAULTS,
     )
 
     return dict(grid=grid)
 
 
+def employee_name_query(value):
+    """
+    the employees whose full name or last name starts with value, case insensitive
+
+    both are ranges on an index, lower(fullname) and employee_lookup__idx
+
+    :param value: the searched name
+    :return: dal query
+    """
+    text = value.strip().lower()
+    if not text:
+        return db.employee.id > 0
+    upper = text[:-1] + chr(ord(text[-1]) + 1)
+    fullname = db.employee.fullname.lower()
+    last_name = db.employee.last_name.lower()
+    return ((fullname >= text) & (fullname < upper)) | (
+        (last_name >= text) & (last_name < upper)
+    )
+
+
 @action("employees", method=["POST", "GET"])
 @action("employees/<path:path>", method=["POST", "GET"])
 @action.uses(
+    timing,
     "grid.html",
     session,
     db,
     auth,
+    compress,
+    timing.end,
 )
 def employees(path=None):
-    queries = [(db.employee.id > 0)]
+    #  the name column and its search read employee.fullname
+    backfill_employee_fullname()
+    #  not id > 0, a rowid range the planner would pick over the active partial indexes
+    queries = [(db.employee.id != None)]
     orderby = [db.employee.last_name, db.employee.first_name]
 
     search_queries = [
@@ -353,23 +1054,28 @@ def employees(path=None):
             "Search by Company",
             lambda val: db.company.id == val,
             db.employee.company.requires,
+            widget=LookupWidget(db.employee.company),
         ),
         GridSearchQuery(
             "Search by Department",
             lambda val: db.department.id == val,
             db.employee.department.requires,
+            widget=LookupWidget(db.employee.department),
         ),
+        GridSearchQuery("Search by Name", employee_name_query),
+        #  most employees are former ones, the grid opens on the active ones
         GridSearchQuery(
-            "Search by Name",
-            lambda val: "first_name || ' ' || last_Name LIKE '%%%s%%'" % val,
+            "Active",
+            lambda val: db.employee.active == True,
+            datatype="boolean",
+            default=True,
         ),
     ]
     search = GridSearch(search_queries, queries)
 
     fields = [
         db.employee.id,
-        db.employee.first_name,
-        db.employee.last_name,
+        db.employee.fullname,
         db.company.name,
         db.department.name,
         db.employee.hired,
@@ -392,18 +1098,101 @@ def employees(path=None):
         details=True,
         editable=True,
         deletable=True,
-        **GRID_DEFAULTS
+        auto_process=False,
+        **GRID_DEFAULTS,
     )
 
     grid.formatters_by_type["boolean"] = (
         lambda value: SPAN(I(_class="fas fa-check-circle")) if value else ""
     )
-    grid.formatters_by_type["date"] = lambda value: XML(
-        '<script>document.write((new Date(%s,%s,%s)).toLocaleDateString({month: "2-digit", day: "2-digit", year: "numeric"}).split(",")[0])</script>'
-        % (
-            value.year,
-            value.month,
-            value.day,
-        )
+    #  localized in the browser by grid.html
+    grid.formatters_by_type["date"] = lambda value: (
+        XML('<time class="grid-date" datetime="%s">%s</time>' % (value, value))
+        if value
+        else ""
     )
+
+    grid = lazy_grid(grid, db.employee, db.company, db.department)
+    if grid.fragment:
+        return grid.render()
+
     return dict(grid=grid)
+
+
+@metrics.collector
+def cache_metrics():
+    """
+    the counters of the response cache, the compiled statements and the single flights
+    """
+    stats = cache.stats()
+    return [
+        (
+            "cache_lookups_total",
+            "counter",
+            "Cache lookups per key namespace, by result",
+            [
+                (dict(namespace=namespace, result=result), values[result])
+                for namespace, values in stats.items()
+                for result in ("hits", "misses", "shared")
+            ],
+        ),
+        (
+            "statement_cache_lookups_total",
+            "counter",
+            "Compiled datatables statements, by result",
+            [
+                (dict(result="hits"), statements.hits),
+                (dict(result="misses"), statements.misses),
+            ],
+        ),
+        (
+            "single_flight_shared_total",
+            "counter",
+            "Calls that waited for and shared the result of an identical running call",
+            [
+                (dict(flight="cache"), cache.flights.shared),
+                (dict(flight="datatables"), flights.shared),
+            ],
+        ),
+    ]
+
+
+if log_writer:
+
+    @metrics.collector
+    def log_metrics():
+        return [
+            (
+                "log_records_dropped_total",
+                "counter",
+                "Log records dropped because the queue of the log writer was full",
+                [({}, log_writer.dropped)],
+            )
+        ]
+
+
+def metrics_allowed():
+    """
+    :return: True when the request has the METRICS_TOKEN or comes from METRICS_ALLOWED_IPS
+    """
+    if settings.METRICS_TOKEN and hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(),
+        ("Bearer %s" % settings.METRICS_TOKEN).encode(),
+    ):
+        return True
+    return request.environ.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+
+
+@action("metrics", method=["GET"])
+def metrics_export():
+    """
+    the request phase histograms and the cache counters of this worker, for prometheus
+
+    only for METRICS_TOKEN and METRICS_ALLOWED_IPS, see settings.py
+
+    :return: prometheus text format
+    """
+    if not metrics_allowed():
+        abort(403)
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.prometheus()
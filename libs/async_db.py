@@ -0,0 +1,102 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .interrupt import interruptible
+
+
+class ReadPool:
+    def __init__(self, db, size=8):
+        """
+        run read only sql on a dedicated pool of threads so coroutines never block on the db
+
+        pydal keeps one connection per thread, so every pool thread opens its own connection
+        on first use and keeps it for the life of the process.  any number of requests can
+        be waiting on the pool, at most size queries run at the same time.
+
+        :param db: dal reference
+        :param size: number of db threads / connections
+        """
+        self.db = db
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db")
+        self.flights = dict()
+
+    def run(self, sql, budget=None, placeholders=None):
+        try:
+            with interruptible(self.db, budget=budget):
+                return self.db.executesql(sql, placeholders=placeholders)
+        finally:
+            #  end the read transaction, a long lived one would pin the sqlite WAL
+            self.db.rollback()
+
+    def snapshot(self, sql, placeholders, version_sql, budget=None, cancelled=None):
+        try:
+            with interruptible(self.db, budget=budget, cancelled=cancelled):
+                version = None
+                if version_sql:
+                    #  one read transaction for the version and the statement
+                    self.db.executesql("BEGIN")
+                    version = self.db.executesql(version_sql)
+                return version, self.db.executesql(sql, placeholders=placeholders)
+        finally:
+            self.db.rollback()
+
+    def read(self, statements, version_sql=None, budget=None, cancelled=None):
+        """
+        run statements at the same time from a thread that is not a coroutine, each on a
+        pool thread and connection
+
+        every connection reads its own snapshot.  with version_sql, a query whose result
+        changes with every write (the change log version), each statement reads the version
+        in the same transaction and the results are only returned when all read the same
+        one, that is when they all saw the same data
+
+        :param statements: list of (sql, values to bind or None)
+        :param version_sql: sql reading the version of the data
+        :param budget: seconds each statement may run, see libs/interrupt.py
+        :param cancelled: function, True when the results are no longer wanted
+        :return: list of the results in the order of statements, None when a write
+                 happened between the statements
+        :raises QueryInterrupted: when a statement ran out of budget or was cancelled
+        """
+        futures = [
+            self.executor.submit(
+                self.snapshot, sql, placeholders, version_sql, budget, cancelled
+            )
+            for sql, placeholders in statements
+        ]
+        results = [future.result() for future in futures]
+        if len({repr(version) for version, _ in results}) > 1:
+            return None
+        return [rows for _, rows in results]
+
+    async def execute(self, sql, budget=None, placeholders=None, version=None):
+        """
+        execute sql on a pool thread
+
+        the same statement awaited again while it runs is not run twice, the callers share
+        the result.  a caller that is cancelled stops waiting, the statement goes on for
+        the others
+
+        :param sql: sql statement, build it with db(query)._select() / ._count()
+        :param budget: seconds the statement may run, see libs/interrupt.py
+        :param placeholders: values to bind
+        :param version: the write generation of the tables read (cache.generation), read
+                        before the call.  a call made after a write does not share the
+                        result of a statement started before it
+        :return: list of tuples, shared - do not change it
+        :raises QueryInterrupted: when the statement ran out of budget
+        """
+        key = (sql, tuple(placeholders or ()), budget, version)
+        future = self.flights.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.executor, self.run, sql, budget, placeholders
+            )
+            self.flights[key] = future
+            future.add_done_callback(lambda _: self.flights.pop(key, None))
+        return await asyncio.shield(future)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
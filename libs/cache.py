@@ -0,0 +1,355 @@
+import functools
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class MemoryStore:
+    def __init__(self, size=1000):
+        """
+        per process LRU store - nothing is shared between workers
+
+        :param size: maximum number of cached values
+        """
+        self.size = size
+        self.data = OrderedDict()
+        self.generations = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return MISSING
+            value, expires = item
+            if expires < time.time():
+                del self.data[key]
+                return MISSING
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, expiration):
+        with self.lock:
+            self.data[key] = (value, time.time() + expiration)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def counter(self, name):
+        return self.generations.get(name, 0)
+
+    def incr(self, name):
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+            return self.generations[name]
+
+
+class SQLiteStore:
+    def __init__(self, filename, size=10000, mmap_size=64 * 1024 * 1024):
+        """
+        store shared by all the worker processes on this box
+
+        values are pickled into a WAL mode SQLite file that is memory mapped by every worker
+
+        :param filename: path of the SQLite file, created if missing
+        :param size: maximum number of cached values, the ones closest to expiring are dropped first
+        :param mmap_size: bytes of the file to memory map
+        """
+        self.filename = filename
+        self.size = size
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+        self.writes = 0
+
+    @property
+    def connection(self):
+        #  one connection per thread, and never reuse one inherited through fork
+        if getattr(self.local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB, expires REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS generation "
+                "(name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < time.time():
+            return MISSING
+        return pickle.loads(row[0])
+
+    def set(self, key, value, expiration):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value), time.time() + expiration),
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        self.connection.execute(
+            "DELETE FROM cache WHERE expires < ? OR key IN "
+            "(SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (time.time(), self.size),
+        )
+
+    def counter(self, name):
+        row = self.connection.execute(
+            "SELECT value FROM generation WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, name):
+        #  the value of this increment, not one from another worker after it
+        return self.connection.execute(
+            "INSERT INTO generation (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value",
+            (name,),
+        ).fetchone()[0]
+
+
+class RedisStore:
+    def __init__(self, conn, prefix="simple_table:"):
+        """
+        store shared by all the workers using the same redis server
+
+        :param conn: redis.Redis connection
+        :param prefix: prefix for all the redis keys
+        """
+        self.conn = conn
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.conn.get(self.prefix + "cache:" + key)
+        return MISSING if data is None else pickle.loads(data)
+
+    def set(self, key, value, expiration):
+        self.conn.set(
+            self.prefix + "cache:" + key,
+            pickle.dumps(value),
+            ex=max(1, int(expiration)),
+        )
+
+    def counter(self, name):
+        return int(self.conn.get(self.prefix + "generation:" + name) or 0)
+
+    def incr(self, name):
+        return self.conn.incr(self.prefix + "generation:" + name)
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        concurrent calls for the same key in this process run once and share the result
+
+        the first caller runs the function, the others wait for it and get its value or its
+        exception.  nothing is kept once the call returns, that is the job of the cache
+        """
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.shared = 0
+
+    def do(self, key, func, share_error=None):
+        """
+        :param key: the call, include the generation of the tables it reads
+        :param func: function computing the value
+        :param share_error: optional function, False for an error only the caller that ran
+                            func should get (it was cancelled) - the waiting callers then
+                            call again
+        :return: the value
+        """
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = dict(
+                        done=threading.Event(), value=None, error=None
+                    )
+                else:
+                    self.shared += 1
+            if leader:
+                break
+            call["done"].wait()
+            if call["error"] is None:
+                return call["value"]
+            if share_error is None or share_error(call["error"]):
+                raise call["error"]
+
+        try:
+            call["value"] = func()
+            return call["value"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+
+class SharedCache:
+    def __init__(self, store):
+        """
+        drop-in replacement for the py4web Cache backed by a pluggable store
+
+        keys are namespaced by the text before the first ":" and hits/misses are counted per
+        namespace.  tables registered with track_writes() get a write generation in the store,
+        put cache.generation(tablename) in a key to have every worker drop it after a write.
+
+        concurrent misses of a key in a worker compute the value once, the other callers wait
+        for it (see SingleFlight) and are counted as shared
+
+        :param store: MemoryStore, SQLiteStore or RedisStore
+        """
+        self.store = store
+        self.hits = dict()
+        self.misses = dict()
+        self.shared = dict()
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+        #  tables written by the transaction of each thread
+        self.local = threading.local()
+        #  tablename: functions called after its bumps, see track_writes
+        self.committed = dict()
+
+    def get(self, key, callback, expiration=3600, monitor=None):
+        """
+        return the cached value of key, calling callback() to compute it when missing or expired
+
+        :param key: cache key, "namespace:..."
+        :param callback: function computing the value
+        :param expiration: seconds to keep the value
+        :param monitor: optional function, the value is recomputed when its result changes
+        :return: the value
+        """
+        m = monitor and monitor()
+        item = self.store.get(key)
+        namespace = key.split(":", 1)[0]
+        if item is not MISSING and item[1] == m:
+            self.count(self.hits, namespace)
+            return item[0]
+        computed = []
+
+        def compute():
+            computed.append(True)
+            value = callback()
+            self.store.set(key, (value, m), expiration)
+            return value
+
+        value = self.flights.do(key, compute)
+        self.count(self.misses if computed else self.shared, namespace)
+        return value
+
+    def memoize(self, expiration=3600):
+        def decorator(func):
+            @functools.wraps(func)
+            def memoized_func(*args, **kwargs):
+                key = "%s:%s:%s:%s" % (func.__module__, func.__name__, args, kwargs)
+                return self.get(
+                    key,
+                    lambda args=args, kwargs=kwargs: func(*args, **kwargs),
+                    expiration=expiration,
+                )
+
+            return memoized_func
+
+        return decorator
+
+    def count(self, counters, namespace):
+        with self.lock:
+            counters[namespace] = counters.get(namespace, 0) + 1
+
+    def generation(self, name):
+        return self.store.counter(name)
+
+    def bump(self, name):
+        return self.store.incr(name)
+
+    def track_writes(self, table, committed=None):
+        """
+        bump the generation of the table after every commit that inserted, updated or
+        deleted rows in it
+
+        use as db.define_table(..., on_define=cache.track_writes) and have the db call
+        commit() and rollback() after its own (see libs/dal.py).  bumping before the commit
+        would let another worker cache the old rows under the new generation
+
+        :param table: pydal Table
+        :param committed: function called with the generation of every bump, in the
+                          thread that committed
+        :return:
+        """
+
+        def wrote(*args, tablename=table._tablename):
+            self.wrote(tablename)
+
+        table._after_insert.append(wrote)
+        table._after_update.append(wrote)
+        table._after_delete.append(wrote)
+        if committed:
+            self.committed.setdefault(table._tablename, []).append(committed)
+
+    def wrote(self, tablename):
+        """
+        the transaction of this thread wrote to tablename, bumped by the next commit()
+        """
+        written = getattr(self.local, "written", None)
+        if written is None:
+            written = self.local.written = set()
+        written.add(tablename)
+
+    def commit(self):
+        """
+        bump the tables written by the transaction of this thread, call after db.commit()
+        """
+        written, self.local.written = getattr(self.local, "written", None), None
+        for tablename in sorted(written or ()):
+            generation = self.bump(tablename)
+            for committed in self.committed.get(tablename, ()):
+                committed(generation)
+
+    def rollback(self):
+        """
+        forget the writes of the transaction of this thread, call after db.rollback()
+        """
+        self.local.written = None
+
+    def stats(self):
+        """
+        hits, misses, shared misses and hit ratio per key namespace since this worker started
+
+        a shared miss waited for the value computed for a concurrent miss, it counts as a hit
+        in the ratio
+
+        :return: dict of namespace: dict(hits=, misses=, shared=, ratio=)
+        """
+        stats = dict()
+        for namespace in sorted(set(self.hits) | set(self.misses) | set(self.shared)):
+            hits = self.hits.get(namespace, 0)
+            misses = self.misses.get(namespace, 0)
+            shared = self.shared.get(namespace, 0)
+            stats[namespace] = dict(
+                hits=hits,
+                misses=misses,
+                shared=shared,
+                ratio=(hits + shared) / float(hits + misses + shared),
+            )
+        return stats
@@ -0,0 +1,144 @@
+class ChangeLog:
+    def __init__(self, db, fields, name="change_log", size=100000):
+        """
+        change feed of some tables, kept by sqlite triggers
+
+        every insert, update and delete adds (version, tablename, record_id, operation) to
+        the log, version is an AUTOINCREMENT key so it only grows.  a client reads
+        version() first, then the data, then asks for changes() since that version from time
+        to time and applies them - a change seen twice does no harm.
+
+        the log keeps about the last `size` changes, a client that falls further behind is
+        told to reset (read everything again)
+
+        :param db: dal reference
+        :param fields: tablename: the fieldnames sent to the clients, of the tables to log
+        :param name: the log table
+        :param size: changes to keep
+        """
+        self.db = db
+        self.fields = dict(fields)
+        self.tablenames = list(self.fields)
+        self.name = name
+        self.size = size
+        #  set once the log was found, migrate may create it after the workers start
+        self.found = False
+
+    def exists(self):
+        """
+        :return: True when migrate created the log (sqlite only)
+        """
+        if not self.found and self.db._dbname == "sqlite":
+            self.found = bool(
+                self.db.executesql(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    placeholders=(self.name,),
+                )
+            )
+        return self.found
+
+    def sql(self):
+        """
+        the statements creating the log and the triggers of every table
+
+        :return: list of sql statements, run by migrate
+        """
+        statements = [
+            "CREATE TABLE IF NOT EXISTS {log} ("
+            "version INTEGER PRIMARY KEY AUTOINCREMENT, tablename TEXT NOT NULL, "
+            "record_id INTEGER NOT NULL, operation CHAR(1) NOT NULL);",
+            "CREATE INDEX IF NOT EXISTS {log}_table__idx ON {log} (tablename, version);",
+            #  trim every 1000 changes, not on every write
+            "CREATE TRIGGER IF NOT EXISTS {log}_trim AFTER INSERT ON {log} "
+            "WHEN new.version % 1000 = 0 BEGIN "
+            "DELETE FROM {log} WHERE version <= new.version - {size}; END;",
+        ]
+        for tablename in self.tablenames:
+            for event, row, operation in (
+                ("insert", "new", "i"),
+                ("update", "new", "u"),
+                ("delete", "old", "d"),
+            ):
+                statements.append(
+                    "CREATE TRIGGER IF NOT EXISTS {log}_%(table)s_%(event)s "
+                    "AFTER %(event)s ON %(table)s BEGIN "
+                    "INSERT INTO {log} (tablename, record_id, operation) "
+                    "VALUES ('%(table)s', %(row)s.id, '%(operation)s'); END;"
+                    % dict(table=tablename, event=event, row=row, operation=operation)
+                )
+        return [
+            statement.format(log=self.name, size=self.size) for statement in statements
+        ]
+
+    def version_sql(self):
+        """
+        :return: sql reading the version, no rows before the first change.  the log
+                 must exist, before migrate created it the sql reads no rows either
+        """
+        return "SELECT seq FROM sqlite_sequence WHERE name = '%s'" % self.name
+
+    def version(self):
+        """
+        :return: the version of the last change of any table, 0 before the first one
+        """
+        rows = self.db.executesql(self.version_sql())
+        return rows[0][0] if rows else 0
+
+    def changes(self, tablename, since, limit=1000):
+        """
+        the records of a table changed after a version, by their first and last change
+
+            inserted    first change an insert, still there
+            updated     changed, not deleted
+            deleted     last change a delete
+
+        a record inserted and deleted in between is reported as deleted
+
+        :param tablename: one of the logged tables
+        :param since: the version the client has
+        :param limit: changes read at most, more is True when there are others after them
+        :return: dict(version=, reset=, more=, inserted=, updated=, deleted=), lists of
+                 record ids in the order of their last change.  reset is True when changes
+                 after since were trimmed, the client then reads everything again
+        """
+        current = self.version()
+        oldest = self.db.executesql("SELECT min(version) FROM %s" % self.name)[0][0]
+        result = dict(
+            version=current,
+            reset=False,
+            more=False,
+            inserted=[],
+            updated=[],
+            deleted=[],
+        )
+        if since >= current:
+            return result
+        if oldest is None or since < oldest - 1:
+            result["reset"] = True
+            return result
+
+        rows = self.db.executesql(
+            "SELECT version, record_id, operation FROM %s "
+            "WHERE tablename = ? AND version > ? ORDER BY version LIMIT ?" % self.name,
+            placeholders=[tablename, since, limit + 1],
+        )
+        if len(rows) > limit:
+            rows = rows[:limit]
+            result["more"] = True
+            result["version"] = rows[-1][0]
+
+        first = dict()
+        last = dict()
+        for version, record_id, operation in rows:
+            first.setdefault(record_id, operation)
+            #  keep the records in the order of their last change
+            last.pop(record_id, None)
+            last[record_id] = operation
+        for record_id, operation in last.items():
+            if operation == "d":
+                result["deleted"].append(record_id)
+            elif first[record_id] == "i":
+                result["inserted"].append(record_id)
+            else:
+                result["updated"].append(record_id)
+        return result
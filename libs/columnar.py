@@ -0,0 +1,329 @@
+import threading
+from array import array
+from itertools import compress, islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Column:
+    def __init__(self, values):
+        """
+        dictionary encoded column: the distinct values once, a code per row
+
+        codes are given in order of appearance, rank[code] is the place of the value in
+        sorted order (None first, like SQLite)
+
+        :param values: the value of every row
+        """
+        self.dictionary = []
+        self.index = dict()
+        self.codes = array("I", (self.encode(value) for value in values))
+        self.rank_codes()
+
+    def encode(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.dictionary)
+            self.dictionary.append(value)
+        return code
+
+    def rank_codes(self):
+        order = sorted(
+            range(len(self.dictionary)),
+            key=lambda code: (self.dictionary[code] is not None, self.dictionary[code]),
+        )
+        self.rank = array("I", bytes(4 * len(order)))
+        for rank, code in enumerate(order):
+            self.rank[code] = rank
+
+    def copy(self):
+        column = Column.__new__(Column)
+        column.dictionary = list(self.dictionary)
+        column.index = dict(self.index)
+        column.codes = array("I", self.codes)
+        column.rank = self.rank
+        return column
+
+    def matching_codes(self, test):
+        """
+        :param test: function of a value
+        :return: lookup table, byte per code, 1 when test(value) is true
+        """
+        return bytes(1 if test(value) else 0 for value in self.dictionary)
+
+
+class ColumnStore:
+    def __init__(self, db, tablename, fieldnames, generation=None):
+        """
+        read only in-memory copy of some columns of a table, for searches, sorts and pages
+        without going to the database
+
+        filters are evaluated once per distinct value and mapped to the rows through the
+        codes, sorts use the ranks of the codes and are kept until the data changes.  numpy
+        vectorizes the row loops when installed.
+
+        the rows written by this process are applied row by row once committed: register
+        track_writes as an on_define hook of the table, committed() with the bumps of its
+        generation after a commit and rollback() after the rollbacks of the db.  when the
+        generation moved past one not committed here, another worker wrote to the table
+        and the whole table is read again
+
+        :param db: dal reference
+        :param tablename: the table
+        :param fieldnames: the columns to keep, besides the id
+        :param generation: function returning the write generation of the table
+        """
+        self.db = db
+        self.tablename = tablename
+        self.fieldnames = list(fieldnames)
+        self.generation = generation or (lambda: 0)
+        self.lock = threading.Lock()
+        self.state = None
+        #  ids written by the committed transactions of this process, not applied yet
+        self.pending = set()
+        #  the generations of those commits
+        self.own = set()
+        #  ids written by the transaction of each thread
+        self.local = threading.local()
+
+    #  keeping up with writes
+
+    def track_writes(self, table):
+        """
+        on_define hook recording the ids written by the transaction of the thread
+
+        :param table: pydal Table
+        :return:
+        """
+
+        def written():
+            if getattr(self.local, "pending", None) is None:
+                self.local.pending = set()
+            return self.local.pending
+
+        def before(dbset):
+            written().update(
+                row[table._id.name] for row in dbset.select(table._id, cacheable=True)
+            )
+
+        def after_insert(fields, id):
+            written().add(id)
+
+        table._after_insert.append(after_insert)
+        table._before_update.append(lambda dbset, fields: before(dbset))
+        table._before_delete.append(before)
+
+    def committed(self, generation):
+        """
+        the transaction of this thread was committed and the generation bumped to generation
+        """
+        ids, self.local.pending = getattr(self.local, "pending", None), None
+        with self.lock:
+            self.pending.update(ids or ())
+            self.own.add(generation)
+
+    def rollback(self):
+        """
+        the transaction of this thread was rolled back, its writes are gone
+        """
+        self.local.pending = None
+
+    def current(self):
+        """
+        :return: the loaded state, reloaded or patched when the table changed
+        """
+        generation = self.generation()
+        state = self.state
+        if state is not None and state["generation"] == generation:
+            return state
+        with self.lock:
+            state = self.state
+            if state is None or state["generation"] != generation:
+                if state is not None and all(
+                    own in self.own
+                    for own in range(state["generation"] + 1, generation + 1)
+                ):
+                    state = self.patch(state, generation)
+                else:
+                    state = self.load(generation)
+                self.own = {own for own in self.own if own > generation}
+                self.state = state
+            return state
+
+    def select(self, query):
+        table = self.db[self.tablename]
+        return self.db.executesql(
+            self.db(query)._select(
+                table._id, *[table[name] for name in self.fieldnames], orderby=table._id
+            )
+        )
+
+    def load(self, generation):
+        self.pending = set()
+        rows = self.select(self.db[self.tablename]._id > 0)
+        return self.build(
+            generation,
+            array("q", (row[0] for row in rows)),
+            [
+                Column(row[index + 1] for row in rows)
+                for index in range(len(self.fieldnames))
+            ],
+            bytearray(b"\x01" * len(rows)),
+        )
+
+    def patch(self, state, generation):
+        ids, self.pending = sorted(self.pending), set()
+        table = self.db[self.tablename]
+        rows = {row[0]: row for row in self.select(table._id.belongs(ids))}
+        position = dict(state["position"])
+        row_ids = array("q", state["ids"])
+        columns = [column.copy() for column in state["columns"].values()]
+        live = bytearray(state["live"])
+        for id in ids:
+            row = rows.get(id)
+            index = position.get(id)
+            if row is None:
+                if index is not None:
+                    live[index] = 0
+                continue
+            if index is None:
+                index = position[id] = len(row_ids)
+                row_ids.append(id)
+                live.append(1)
+                for number, column in enumerate(columns):
+                    column.codes.append(column.encode(row[number + 1]))
+            else:
+                live[index] = 1
+                for number, column in enumerate(columns):
+                    column.codes[index] = column.encode(row[number + 1])
+        for column in columns:
+            if len(column.dictionary) != len(column.rank):
+                column.rank_codes()
+        return self.build(generation, row_ids, columns, live, position)
+
+    def build(self, generation, ids, columns, live, position=None):
+        columns = dict(zip(self.fieldnames, columns))
+        if numpy is not None:
+            codes = {
+                name: numpy.frombuffer(column.codes, dtype=numpy.uint32)
+                for name, column in columns.items()
+            }
+            live_mask = numpy.frombuffer(bytes(live), dtype=numpy.uint8).astype(bool)
+        else:
+            codes = {name: column.codes for name, column in columns.items()}
+            live_mask = bytes(live)
+        return dict(
+            generation=generation,
+            ids=ids,
+            columns=columns,
+            codes=codes,
+            live=live,
+            live_mask=live_mask,
+            total=live.count(1),
+            position=position or {id: index for index, id in enumerate(ids)},
+            sorts=dict(),
+        )
+
+    #  reading
+
+    def supports(self, fieldnames):
+        return all(name == "id" or name in self.fieldnames for name in fieldnames)
+
+    def sort(self, state, orderby):
+        """
+        :param orderby: list of (fieldname, descending)
+        :return: row indexes in order, kept in the state
+        """
+        key = tuple(orderby)
+        if key not in state["sorts"]:
+            #  stable sorts from the last key to the first
+            order = list(range(len(state["ids"])))
+            for name, descending in reversed(orderby):
+                if name == "id":
+                    values = state["ids"]
+                else:
+                    column = state["columns"][name]
+                    values = list(map(column.rank.__getitem__, column.codes))
+                order.sort(key=values.__getitem__, reverse=descending)
+            state["sorts"][key] = (
+                numpy.array(order, dtype=numpy.int64) if numpy is not None else order
+            )
+        return state["sorts"][key]
+
+    def mask(self, state, name, test):
+        """
+        the rows whose value in the column passes test, test runs once per distinct value
+
+        :return: numpy bool array, or bytes of 0/1 without numpy
+        """
+        lookup = state["columns"][name].matching_codes(test)
+        if numpy is not None:
+            lookup = numpy.frombuffer(lookup, dtype=numpy.uint8).astype(bool)
+            return lookup[state["codes"][name]]
+        return bytes(map(lookup.__getitem__, state["codes"][name]))
+
+    def query(self, filters, search, search_fields, orderby, start, length):
+        """
+        the page of a search
+
+        :param filters: list of (fieldname, "equals"|"startswith", value)
+        :param search: text contained in one of search_fields, case insensitive like LIKE
+        :param search_fields: fieldnames for the search
+        :param orderby: list of (fieldname, descending)
+        :param start: first row of the page
+        :param length: rows in the page, -1 for all the rows from start
+        :return: (total rows, filtered rows, list of dicts of id and fieldnames)
+        """
+        state = self.current()
+        selected = state["live_mask"]
+        for name, search_type, value in filters:
+            if search_type == "equals":
+                test = lambda v, value=value: v == value
+            else:
+                test = lambda v, value=value: v is not None and v.startswith(value)
+            selected = mask_and(selected, self.mask(state, name, test))
+        if search:
+            text = search.lower()
+            found = None
+            for name in search_fields:
+                mask = self.mask(
+                    state, name, lambda v: v is not None and text in v.lower()
+                )
+                found = mask if found is None else mask_or(found, mask)
+            selected = mask_and(selected, found)
+
+        order = self.sort(state, orderby)
+        #  datatables sends -1 for all the rows
+        end = start + length if length >= 0 else None
+        if numpy is not None:
+            filtered = int(selected.sum())
+            page = order[selected[order]][start:end].tolist()
+        else:
+            filtered = selected.count(1)
+            page = list(
+                islice(compress(order, map(selected.__getitem__, order)), start, end)
+            )
+
+        ids = state["ids"]
+        rows = []
+        for index in page:
+            row = dict(id=ids[index])
+            for name, column in state["columns"].items():
+                row[name] = column.dictionary[column.codes[index]]
+            rows.append(row)
+        return state["total"], filtered, rows
+
+
+def mask_and(a, b):
+    if numpy is not None:
+        return a & b
+    return (int.from_bytes(a, "big") & int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def mask_or(a, b):
+    if numpy is not None:
+        return a | b
+    return (int.from_bytes(a, "big") | int.from_bytes(b, "big")).to_bytes(len(a), "big")
@@ -0,0 +1,256 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from py4web import request, response, abort
+from py4web.core import Fixture, bottle
+
+from .metrics import phase
+
+#  encoding: suffix of the precompressed file, best first
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+
+
+def accepted_encodings(header):
+    """
+    :param header: the Accept-Encoding header
+    :return: set of the encodings accepted, those with q=0 left out
+    """
+    accepted = set()
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if name:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def negotiate(header, available=None):
+    """
+    the encoding to send, brotli before gzip
+
+    :param header: the Accept-Encoding header
+    :param available: encodings to choose from, default br (when installed) and gzip
+    :return: "br", "gzip" or None for the body as is
+    """
+    if available is None:
+        available = [name for name in SUFFIXES if name != "br" or brotli]
+    accepted = accepted_encodings(header)
+    for name in available:
+        if name in accepted or "*" in accepted:
+            return name
+    return None
+
+
+def compress(body, encoding, level=6):
+    """
+    :param body: bytes
+    :param encoding: "br" or "gzip"
+    :param level: 1 to 9, the brotli quality is level + 2 (11 for 9)
+    :return: the compressed bytes, the same for the same body (no gzip timestamp)
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=min(11, level + 2))
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+class Compress(Fixture):
+    def __init__(self, min_size=1024, level=6, cache=None, expiration=30, enabled=True):
+        """
+        gzip or brotli the output of an action for the clients that accept it
+
+        put it after the template in action.uses, the outputs are transformed in that order.
+        an action whose output is kept in a response cache calls cache_as() with the key of
+        that cache, the compressed bytes are then cached next to it and expire with it
+
+        :param min_size: bytes, smaller outputs are sent as they are
+        :param level: compression level, 1 to 9
+        :param cache: SharedCache for the compressed outputs
+        :param expiration: seconds to keep a compressed output
+        :param enabled: set to False to send every output as it is
+        """
+        self.min_size = min_size
+        self.level = level
+        self.cache = cache
+        self.expiration = expiration
+        self.enabled = enabled
+        self.local = threading.local()
+
+    def on_request(self):
+        self.local.key = None
+
+    def cache_as(self, key):
+        """
+        the output of the current request is the value of key in the response cache
+
+        :param key: cache key, holding the generation of the data like the cached value
+        :return:
+        """
+        self.local.key = key
+
+    def transform(self, output, shared_data=None):
+        key, self.local.key = getattr(self.local, "key", None), None
+        if not self.enabled or not isinstance(output, (str, bytes)):
+            return output
+        vary = response.headers.get("Vary")
+        if not vary:
+            response.headers["Vary"] = "Accept-Encoding"
+        elif "accept-encoding" not in vary.lower():
+            response.headers["Vary"] = vary + ", Accept-Encoding"
+
+        content_type = response.headers.get("Content-Type") or "text/html"
+        if "Content-Encoding" in response.headers or not content_type.startswith(
+            COMPRESSIBLE_TYPES
+        ):
+            return output
+        body = output.encode("utf8") if isinstance(output, str) else output
+        if len(body) < self.min_size:
+            return output
+        encoding = negotiate(request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return output
+
+        with phase("serialize"):
+            if key and self.cache:
+                data = self.cache.get(
+                    "compressed:%s:%s" % (encoding, key),
+                    lambda: compress(body, encoding, self.level),
+                    self.expiration,
+                )
+            else:
+                data = compress(body, encoding, self.level)
+        response.headers["Content-Encoding"] = encoding
+        return data
+
+
+class StaticAssets:
+    def __init__(self, folder, subfolders=("css", "js"), max_age=365 * 24 * 3600):
+        """
+        the css and js of the app, precompressed and cached by the browsers for max_age
+
+        build() writes a .gz (and a .br when brotli is installed) next to every file.
+        version() goes in __static_version__, so URL("static") and the relative urls under
+        it hold a digest of the files and change with them.  serve() answers those urls with
+        the precompressed file the client accepts and long lived cache headers
+
+        :param folder: the static folder
+        :param subfolders: the folders served, other files are left to py4web
+        :param max_age: seconds the browsers keep a file
+        """
+        self.folder = folder
+        self.subfolders = subfolders
+        self.max_age = max_age
+        self.versions = dict()
+
+    def files(self):
+        """
+        :return: sorted paths of the files, relative to folder, without the compressed ones
+        """
+        paths = []
+        for subfolder in self.subfolders:
+            for root, _, filenames in os.walk(os.path.join(self.folder, subfolder)):
+                for filename in filenames:
+                    if os.path.splitext(filename)[1] not in SUFFIXES.values():
+                        path = os.path.join(root, filename)
+                        paths.append(os.path.relpath(path, self.folder))
+        return sorted(paths)
+
+    def version(self):
+        """
+        :return: "1.x.y" from a digest of the files, the form py4web accepts in static urls
+        """
+        files = self.files()
+        stats = tuple(
+            (path, os.stat(os.path.join(self.folder, path)).st_mtime_ns)
+            for path in files
+        )
+        if stats not in self.versions:
+            self.versions = {stats: self.digest(files)}
+        return self.versions[stats]
+
+    def digest(self, files):
+        digest = hashlib.sha1()
+        for path in files:
+            digest.update(path.encode())
+            with open(os.path.join(self.folder, path), "rb") as stream:
+                digest.update(stream.read())
+        value = digest.hexdigest()
+        return "1.%d.%d" % (int(value[:7], 16), int(value[7:14], 16))
+
+    def build(self, level=9):
+        """
+        write the precompressed files, run on deploy
+
+        :param level: compression level, 1 to 9
+        :return: list of the paths written
+        """
+        written = []
+        for path in self.files():
+            filename = os.path.join(self.folder, path)
+            with open(filename, "rb") as stream:
+                body = stream.read()
+            for encoding, suffix in SUFFIXES.items():
+                if encoding == "br" and not brotli:
+                    continue
+                with open(filename + suffix, "wb") as stream:
+                    stream.write(compress(body, encoding, level))
+                written.append(path + suffix)
+        return written
+
+    def serve(self, path, version=None):
+        """
+        :param path: the file, relative to folder
+        :param version: the version in the url, the cache headers are long lived when it
+                        is the current one
+        :return: bottle HTTPResponse
+        """
+        filename = os.path.realpath(os.path.join(self.folder, path))
+        if (
+            not filename.startswith(os.path.realpath(self.folder) + os.sep)
+            or path.split("/")[0] not in self.subfolders
+            or not os.path.isfile(filename)
+        ):
+            abort(404)
+
+        mtime = os.path.getmtime(filename)
+        encoding = negotiate(
+            request.headers.get("Accept-Encoding"),
+            [
+                name
+                for name, suffix in SUFFIXES.items()
+                if os.path.isfile(filename + suffix)
+                and os.path.getmtime(filename + suffix) >= mtime
+            ],
+        )
+        served = filename + SUFFIXES[encoding] if encoding else filename
+        result = bottle.static_file(
+            os.path.relpath(served, self.folder),
+            root=self.folder,
+            mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        )
+        if result.status_code >= 400:
+            return result
+        if encoding:
+            result.set_header("Content-Encoding", encoding)
+        result.set_header("Vary", "Accept-Encoding")
+        if version is not None and version == self.version():
+            result.set_header(
+                "Cache-Control", "public, max-age=%d, immutable" % self.max_age
+            )
+        else:
+            result.set_header("Cache-Control", "no-cache")
+        return result
@@ -0,0 +1,66 @@
+from py4web import DAL as Py4webDAL
+from pydal import Field
+from pydal.tools.tags import Tags
+
+
+class DAL(Py4webDAL):
+    def __init__(self, *args, **kwargs):
+        """
+        the py4web DAL fixture, with functions called after every commit and rollback
+
+        the functions run in the thread that ended the transaction, once its writes are
+        visible to the other connections (commit) or gone (rollback).  the fixture commits
+        in on_success and rolls back in on_error, scripts call db.commit() themselves
+
+        db.after_commit(function) / db.after_rollback(function) register them
+        """
+        super().__init__(*args, **kwargs)
+        self._after_commit = []
+        self._after_rollback = []
+
+    def after_commit(self, function):
+        self._after_commit.append(function)
+        return function
+
+    def after_rollback(self, function):
+        self._after_rollback.append(function)
+        return function
+
+    def commit(self):
+        super().commit()
+        for function in self._after_commit:
+            function()
+
+    def rollback(self):
+        super().rollback()
+        for function in self._after_rollback:
+            function()
+
+
+class LazyTags(Tags):
+    def __init__(self, db, tablename, name="default"):
+        """
+        pydal Tags on a table, the same methods, without touching the db when created:
+        Tags reads the tagged table and commits right away.  the tag table is defined
+        with the others, on first use with lazy tables, and created by migrate.py
+
+        :param db: dal reference
+        :param tablename: the tagged table
+        :param name: the tags, the table "<tablename>_tag_<name>" holds them
+        """
+        self.db = db
+        self.tablename = tablename
+        self.tag_tablename = "%s_tag_%s" % (tablename, name)
+        db.define_table(
+            self.tag_tablename,
+            Field("path"),
+            Field("record_id", "reference %s" % tablename),
+        )
+
+    @property
+    def table(self):
+        return self.db[self.tablename]
+
+    @property
+    def tag_table(self):
+        return self.db[self.tag_tablename]
@@ -1,3 +1,10 @@
+import datetime
+import hashlib
+import json
+import time
+from decimal import Decimal
+from urllib.parse import unquote
+
 from yatl.helpers import (
     DIV,
     TABLE,
@@ -12,9 +19,18 @@ from yatl.helpers import (
     TAG,
     TBODY,
     SCRIPT,
+    INPUT,
+    SELECT,
+    OPTION,
 )
 from py4web import URL
 
+from .cache import MISSING
+
+SEARCH_TYPES = ("equals", "startswith", "range")
+#  seconds a saved state is used, the datatables.net default
+STATE_DURATION = 7200
+
 
 class DataTablesResponse:
     def __init__(
@@ -26,6 +42,9 @@ class DataTablesResponse:
         delete_url=None,
         page_length=15,
         sort_sequence=None,
+        state_cookie="datatables_state",
+        pipeline_pages=1,
+        pipeline_max_age=30,
     ):
         """
         All the data we need to build a datatable
@@ -36,6 +55,11 @@ class DataTablesResponse:
         :param edit_url: edit url to the edit page for the data
         :param page_length: default=15 - number of rows to display by default
         :param sort_sequence: list of a list of columns to sort by
+        :param state_cookie: cookie keeping the saved state, for the page path only, so the
+                             server can render the first draw (see first_draw_vars)
+        :param pipeline_pages: pages asked for per data call, the browser keeps them and
+                               prefetches the pages next to the one shown, 1 for none
+        :param pipeline_max_age: seconds the browser uses the pages it keeps
         """
         self.fields = fields
         self.data_url = data_url
@@ -44,6 +68,10 @@ class DataTablesResponse:
         self.delete_url = delete_url
         self.page_length = page_length
         self.sort_sequence = sort_sequence if sort_sequence else []
+        self.state_cookie = state_cookie
+        self.pipeline_pages = pipeline_pages
+        self.pipeline_max_age = pipeline_max_age
+        self.first_draw = None
 
     def style(self):
         return """
@@ -56,6 +84,10 @@ class DataTablesResponse:
         height: 2em;
         vertical-align: middle;
     }
+    table.dataTable thead th.datatables-filter {
+        padding: 4px;
+        font-weight: normal;
+    }
     table.dataTable tr td {
         vertical-align: middle;
     }
@@ -90,15 +122,17 @@ class DataTablesResponse:
         js = (
             '<script type="text/javascript">'
             "    $(document).ready(function() {"
-            "        $('#datatables_table').DataTable( {"
+            #  tells the draws of this page load from those of other tabs and reloads
+            "        var page_id = Math.random().toString(36).slice(2); "
+            "        var table = $('#datatables_table').DataTable( {"
             '            dom: "lfrtip", '
             "            processing: true, "
             "            serverSide: true, "
             "            lengthMenu: [  [10, 15, 20, -1], [10, 15, 20, 'All']  ], "
             "            pageLength: %s, "
             '            pagingType: "numbers", '
-            '            ajax: "%s", '
-            "            columns: [" % (self.page_length, self.data_url)
+            "            ajax: %s, "
+            "            columns: [" % (self.page_length, self.ajax_script())
         )
         #  add the field values
         for field in self.fields:
@@ -149,15 +183,306 @@ class DataTablesResponse:
         js += (
             ","
             "        stateSave: true, "
+            "        stateDuration: %s, "
+            "        stateSaveCallback: function (settings, data) {"
+            '            document.cookie = "%s=" + encodeURIComponent(JSON.stringify(data)) '
+            '                + "; path=" + window.location.pathname '
+            '                + "; max-age=%s; samesite=lax"; '
+            "        }, "
+            "        stateLoadCallback: function (settings) {"
+            "            var match = document.cookie.match(/(?:^|; )%s=([^;]*)/); "
+            "            try { return match ? JSON.parse(decodeURIComponent(match[1])) : null; } "
+            "            catch (e) { return null; } "
+            "        }, "
             "        select: true, "
+            "        orderCellsTop: true, "
             "    });"
-            '    $(".dataTables_filter input").focus().select();'
-            "});"
-            "</script>"
+            % (STATE_DURATION, self.state_cookie, STATE_DURATION, self.state_cookie)
         )
+        if self.filters():
+            js += self.filter_script()
+        js += '    $(".dataTables_filter input").focus().select();' "});" "</script>"
 
         return str(js)
 
+    def ajax_script(self):
+        """
+        the ajax option: the data call sending the page_id, the first draw is answered
+        from first_draw when it was rendered for the same start, length, search and order
+
+        with pipeline_pages > 1 a data call asks for the block of pipeline_pages pages
+        around the page, the browser keeps the blocks of the current search and order and
+        draws the pages they hold without a call.  once a page is drawn, the blocks of the
+        pages before and after it are fetched in the background when they are missing.
+        a block is used for pipeline_max_age seconds and only with blocks of the same
+        version of the table - the data calls send the generation of the table, a block
+        fetched after a write drops the blocks from before it.  a page restored from the
+        back-forward cache of the browser drops them all
+
+        :return: javascript function
+        """
+        first_draw = "null"
+        if self.first_draw:
+            #  no "</script>" in the page
+            first_draw = json.dumps(
+                self.first_draw, ensure_ascii=False, separators=(",", ":")
+            ).replace("<", "\\u003c")
+        return (
+            "(function () {"
+            "    var first_draw = %s; "
+            "    var pages = %s, max_age = %s * 1000, blocks = [], pending = {}; "
+            "    function draw_key(d) {"
+            "        return JSON.stringify([d.start, d.length, d.search.value, "
+            "            d.order.map(function (o) { return [o.column, o.dir]; }), "
+            "            d.columns.map(function (c) { return c.search.value; })]); "
+            "    } "
+            #  the rows asked for, whatever the page
+            "    function rows_key(d) {"
+            "        return JSON.stringify([d.search.value, "
+            "            d.order.map(function (o) { return [o.column, o.dir]; }), "
+            "            d.columns.map(function (c) { return c.search.value; })]); "
+            "    } "
+            "    function failed(data, callback) {"
+            "        callback({draw: data.draw, data: [], recordsTotal: 0, "
+            '            recordsFiltered: 0, error: "The data could not be loaded"}); '
+            "    } "
+            "    function fresh(block, key) {"
+            "        return block.key === key && Date.now() - block.time < max_age; "
+            "    } "
+            "    function keep(key, start, response) {"
+            "        if (response.error || response.interrupted) return; "
+            "        blocks = blocks.filter(function (b) {"
+            "            return fresh(b, key) && b.version === response.version; "
+            "        }); "
+            "        blocks.push({key: key, start: start, version: response.version, "
+            "            time: Date.now(), response: response}); "
+            "        if (blocks.length > 4) blocks.shift(); "
+            "    } "
+            "    function cached(key, start, length, draw) {"
+            "        for (var i = 0; i < blocks.length; i++) {"
+            "            var b = blocks[i], rows = b.response.data, offset = start - b.start; "
+            "            if (fresh(b, key) && offset >= 0 && Math.min(start + length, "
+            "                    b.response.recordsFiltered) <= b.start + rows.length) {"
+            "                return $.extend({}, b.response, "
+            "                    {draw: draw, data: rows.slice(offset, offset + length)}); "
+            "            } "
+            "        } "
+            "        return null; "
+            "    } "
+            #  the data call for the block holding the page at start, shared by the
+            #  draws and the prefetches asking for it at the same time
+            "    function fetch(data, key, start, length, draw) {"
+            "        var block_start = start - (Math.floor(start / length) %% pages) * length; "
+            '        var id = key + ":" + block_start + ":" + length; '
+            "        if (!pending[id]) {"
+            "            var vars = $.extend({}, data, "
+            "                {start: block_start, length: length * pages}); "
+            #  a prefetch does not supersede the draw of the table on the server
+            "            if (draw === undefined) delete vars.draw; "
+            '            pending[id] = $.ajax({url: "%s", data: vars, dataType: "json", '
+            "                    cache: false}) "
+            "                .done(function (response) { keep(key, block_start, response); }) "
+            "                .always(function () { delete pending[id]; }); "
+            "        } "
+            "        return {start: block_start, request: pending[id]}; "
+            "    } "
+            "    function prefetch(data, key, total) {"
+            "        [data.start + data.length, data.start - data.length].forEach(function (start) {"
+            "            if (start >= 0 && start < total && !cached(key, start, data.length)) {"
+            "                fetch(data, key, start, data.length); "
+            "            } "
+            "        }); "
+            "    } "
+            "    window.addEventListener('pageshow', function (event) {"
+            "        if (event.persisted) { blocks = []; table.draw(false); } "
+            "    }); "
+            "    return function (data, callback, settings) {"
+            "        data.page_id = page_id; "
+            "        var key = rows_key(data); "
+            "        var first = first_draw; "
+            "        first_draw = null; "
+            "        if (first && draw_key(data) === first.key) {"
+            "            keep(key, data.start, first.response); "
+            "            first.response.draw = data.draw; "
+            "            callback(first.response); "
+            "            return; "
+            "        } "
+            "        if (pages < 2 || data.length < 1) {"
+            '            $.ajax({url: "%s", data: data, dataType: "json", cache: false, '
+            "                success: callback, "
+            "                error: function () { failed(data, callback); }}); "
+            "            return; "
+            "        } "
+            "        var page = cached(key, data.start, data.length, data.draw); "
+            "        if (page) {"
+            "            callback(page); "
+            "            prefetch(data, key, page.recordsFiltered); "
+            "            return; "
+            "        } "
+            "        var block = fetch(data, key, data.start, data.length, data.draw); "
+            "        block.request.done(function (response) {"
+            "            var offset = data.start - block.start; "
+            "            callback($.extend({}, response, {draw: data.draw, "
+            "                data: (response.data || []).slice(offset, offset + data.length)})); "
+            "            if (!response.error && !response.interrupted) {"
+            "                prefetch(data, key, response.recordsFiltered); "
+            "            } "
+            "        }).fail(function () { failed(data, callback); }); "
+            "    }; "
+            "})()"
+            % (
+                first_draw,
+                self.pipeline_pages,
+                self.pipeline_max_age,
+                self.data_url,
+                self.data_url,
+            )
+        )
+
+    def first_draw_vars(self, state=None):
+        """
+        the vars datatables.net sends for its first draw: from the saved state when it is
+        valid for datatables.net too, else the page length and sort_sequence
+
+        :param state: the raw value of the state cookie
+        :return: dict, parsed by DataTablesRequest like the vars of a data call
+        """
+        columns = len(self.fields) + 1
+        start, length, search = 0, self.page_length, ""
+        order = [[int(column), direction] for column, direction in self.sort_sequence]
+        searches = [""] * columns
+        try:
+            saved = json.loads(unquote(state)) if state else None
+            if (
+                saved
+                and saved["time"] / 1000 > time.time() - STATE_DURATION
+                and len(saved["columns"]) == columns
+            ):
+                start, length, search, order, searches = (
+                    int(saved["start"]),
+                    int(saved["length"]),
+                    str(saved["search"]["search"]),
+                    [
+                        [int(column), direction]
+                        for column, direction in saved["order"]
+                        if direction in ("asc", "desc")
+                    ],
+                    [str(column["search"]["search"]) for column in saved["columns"]],
+                )
+        except (ValueError, KeyError, TypeError):
+            pass
+
+        vars = {
+            "draw": "1",
+            "start": str(start),
+            "length": str(length),
+            "search[value]": search,
+            "search[regex]": "false",
+        }
+        names = [field.name for field in self.fields] + [""]
+        for index, name in enumerate(names):
+            vars["columns[%s][data]" % index] = name
+            vars["columns[%s][name]" % index] = name
+            vars["columns[%s][search][value]" % index] = searches[index]
+        for number, (column, direction) in enumerate(order):
+            vars["order[%s][column]" % number] = str(column)
+            vars["order[%s][dir]" % number] = direction
+        return vars
+
+    def embed(self, vars, response):
+        """
+        answer the first draw with response instead of a data call, one round trip less
+
+        :param vars: the first_draw_vars() the response was made for
+        :param response: the dict the data call returns for them
+        :return:
+        """
+        order = []
+        while "order[%s][column]" % len(order) in vars:
+            number = len(order)
+            order.append(
+                [
+                    int(vars["order[%s][column]" % number]),
+                    vars["order[%s][dir]" % number],
+                ]
+            )
+        key = [
+            int(vars["start"]),
+            int(vars["length"]),
+            vars["search[value]"],
+            order,
+            [
+                vars["columns[%s][search][value]" % index]
+                for index in range(len(self.fields) + 1)
+            ],
+        ]
+        self.first_draw = dict(
+            key=json.dumps(key, ensure_ascii=False, separators=(",", ":")),
+            response=response,
+        )
+
+    def filters(self):
+        return [field for field in self.fields if field.search_type]
+
+    def filter_row(self):
+        """
+        the header row with a filter control for every column with a search_type
+
+        :return: TR
+        """
+        _tr = TR()
+        for index, field in enumerate(self.fields):
+            _th = TH(_class="datatables-filter")
+            attributes = {"_data-column": index, "_class": "input is-small"}
+            if field.search_type == "equals" and field.options:
+                options = field.options() if callable(field.options) else field.options
+                _th.append(
+                    DIV(
+                        SELECT(
+                            OPTION(""),
+                            *[OPTION(option) for option in options],
+                            **{"_data-column": index},
+                        ),
+                        _class="select is-small is-fullwidth",
+                    )
+                )
+            elif field.search_type == "range":
+                _th.append(INPUT(_placeholder="from,to", **attributes))
+            elif field.search_type:
+                _th.append(
+                    INPUT(
+                        _placeholder="starts with"
+                        if field.search_type == "startswith"
+                        else "",
+                        **attributes,
+                    )
+                )
+            _tr.append(_th)
+        _tr.append(TH(_class="datatables-filter"))
+        return _tr
+
+    def filter_script(self):
+        """
+        send the filter row values as the column searches, restoring the saved ones
+
+        :return: javascript run after the datatable is created
+        """
+        return (
+            "    var filter_timer = null; "
+            "    $('#datatables_table thead [data-column]').each(function() {"
+            "        $(this).val(table.column($(this).data('column')).search()); "
+            "    }).on('click', function(e) { e.stopPropagation(); }"
+            "    ).on('keyup change', function() {"
+            "        var column = table.column($(this).data('column')); "
+            "        var value = $(this).val(); "
+            "        if (column.search() === value) { return; } "
+            "        clearTimeout(filter_timer); "
+            "        filter_timer = setTimeout(function() {"
+            "            column.search(value).draw(); "
+            "        }, 300); "
+            "    });"
+        )
+
     def table(self):
         _html = DIV()
         if self.create_url and self.create_url != "":
@@ -190,6 +515,8 @@ class DataTablesResponse:
             )
         )
         _thead.append(_tr)
+        if self.filters():
+            _thead.append(self.filter_row())
         _table.append(_thead)
         _table.append(TBODY())
 
@@ -197,6 +524,45 @@ class DataTablesResponse:
         return str(_html)
 
 
+class DrawTracker:
+    def __init__(self, store, expiration=600):
+        """
+        the latest draw of every datatable, in a cache store
+
+        each keystroke in the search box is a new draw.  a query still running for an
+        older draw of the same table can be stopped, datatables.net would drop its response.
+        the workers see the draws of each other with the sqlite and redis stores, with
+        the memory store (CACHE_TYPE = "memory") only the draws that reached the same worker
+
+        :param store: MemoryStore, SQLiteStore or RedisStore (cache.store)
+        :param expiration: seconds to remember the draws of a table nobody uses
+        """
+        self.store = store
+        self.expiration = expiration
+
+    def start(self, key, draw):
+        """
+        record a draw as it arrives, unless a newer one already did
+
+        not atomic: two draws of a table arriving together may leave the older one
+        recorded.  the newer one then runs to the end, a draw is never cancelled by an
+        older one
+
+        :param key: the table on one page load of one session, "draw:..."
+        :param draw: DataTablesRequest.draw
+        """
+        latest = self.store.get(key)
+        if latest is MISSING or latest < draw:
+            self.store.set(key, draw, self.expiration)
+
+    def superseded(self, key, draw):
+        """
+        :return: True when a newer draw of the table arrived
+        """
+        latest = self.store.get(key)
+        return latest is not MISSING and latest > draw
+
+
 class DataTablesRequest:
     def __init__(self, get_vars):
         """
@@ -205,6 +571,7 @@ class DataTablesRequest:
         :param get_vars: vars supplied by datatables.net
         """
         self.draw = None
+        self.page_id = ""
         self.start = 0
         self.length = 15
         self.search_value = None
@@ -212,6 +579,12 @@ class DataTablesRequest:
         self.columns = dict()
         self.orderby = dict()
         self.dal_orderby = []
+        self.order_columns = []
+        self.dal_fields = []
+        self.field_names = []
+        self.dal_filters = []
+        self.filter_values = []
+        self.filter_predicates = []
 
         self.get_vars = get_vars
 
@@ -228,7 +601,10 @@ class DataTablesRequest:
             if x == "start":
                 self.start = int(value)
             elif x == "draw":
-                self.draw = value
+                #  echoed back, datatables.net drops responses older than its last draw
+                self.draw = int(value) if value.isdigit() else None
+            elif x == "page_id":
+                self.page_id = value
             elif x == "length":
                 self.length = int(value)
             elif x == "search[value]":
@@ -302,16 +678,21 @@ class DataTablesRequest:
         """
         build a dal orderby clause
 
-        at this time it only supports orderby for 1 table
+        at this time it only supports orderby for 1 table, order_columns keeps the same
+        order as (column name, descending) pairs
 
         :param db: dal reference
         :param table_name: name of the table the colums are in
         :return:
         """
         self.dal_orderby = []
+        self.order_columns = []
         if self.orderby and table_name:
             for ob in self.orderby:
                 column = self.columns[self.orderby[ob]["column"]]
+                self.order_columns.append(
+                    (column["name"], self.orderby[ob]["dir"] == "desc")
+                )
                 if self.orderby[ob]["dir"] == "desc":
                     self.dal_orderby.append(~db[table_name][column["name"]])
                 else:
@@ -319,6 +700,143 @@ class DataTablesRequest:
 
         return
 
+    def project(self, db, table_name, fields):
+        """
+        build the list of dal fields to select, only the columns of the datatable
+
+        DT_RowId is the record id.  with a covering index on these columns SQLite can
+        answer the page from the index without reading the table rows
+
+        :param db: dal reference
+        :param table_name: name of the table the colums are in
+        :param fields: list of DataTablesField objects displayed on the page
+        :return:
+        """
+        table = db[table_name]
+        self.dal_fields = []
+        self.field_names = []
+        for field in fields:
+            if field.name == "DT_RowId":
+                self.dal_fields.append(table._id)
+            else:
+                self.dal_fields.append(table[field.name])
+            self.field_names.append(field.name)
+
+        return
+
+    def filter(self, db, table_name, fields):
+        """
+        build dal queries from the column filters, columns[i][search][value]
+
+        only columns with a search_type in fields are filtered and every filter compiles to
+        a predicate an index on the column can answer:
+            equals      field == value
+            startswith  value <= field < value with the last character incremented
+            range       from <= field <= to, bounds that do not parse are ignored
+        filter_values keeps the filters applied as (column name, search_type, value) and
+        filter_predicates the predicates of dal_filters as (column name, operator, value),
+        the operator one of "=", ">=", "<" and "<="
+
+        :param db: dal reference
+        :param table_name: name of the table the colums are in
+        :param fields: list of DataTablesField objects displayed on the page
+        :return:
+        """
+        search_types = {f.name: f.search_type for f in fields if f.search_type}
+        self.dal_filters = []
+        self.filter_values = []
+        self.filter_predicates = []
+        for column in self.columns.values():
+            name = column.get("name")
+            value = column.get("search_value")
+            if not value or name not in search_types:
+                continue
+            self.filter_values.append((name, search_types[name], value))
+            field = db[table_name][name]
+            if search_types[name] == "equals":
+                self.dal_filters.append(field == value)
+                self.filter_predicates.append((name, "=", value))
+            elif search_types[name] == "startswith":
+                upper = value[:-1] + chr(ord(value[-1]) + 1)
+                self.dal_filters.append((field >= value) & (field < upper))
+                self.filter_predicates += [(name, ">=", value), (name, "<", upper)]
+            else:
+                low, _, high = value.partition(",")
+                low = parse_bound(field, low)
+                high = parse_bound(field, high)
+                if low is not None:
+                    self.dal_filters.append(field >= low)
+                    self.filter_predicates.append((name, ">=", low))
+                if high is not None:
+                    self.dal_filters.append(field <= high)
+                    self.filter_predicates.append((name, "<=", high))
+
+        return
+
+    def cursor(self):
+        """
+        a token for the result set asked for: the search, the column searches and the
+        order, but not the page
+
+        :return: hex digest
+        """
+        key = (
+            self.search_value or "",
+            sorted(
+                (number, column.get("name"), column.get("search_value") or "")
+                for number, column in self.columns.items()
+            ),
+            sorted(
+                (number, orderby.get("column"), orderby.get("dir"))
+                for number, orderby in self.orderby.items()
+            ),
+        )
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def data(self, rows):
+        """
+        the rows selected with dal_fields as the list of dicts datatables.net expects
+
+        :param rows: dal Rows
+        :return: list of dicts keyed by the DataTablesField names
+        """
+        return [
+            {
+                name: row[field.name]
+                for name, field in zip(self.field_names, self.dal_fields)
+            }
+            for row in rows
+        ]
+
+
+def parse_bound(field, value):
+    """
+    convert one side of a range filter to the type of the field
+
+    :param field: dal field
+    :param value: the text typed in the filter
+    :return: the value or None when empty or not valid for the field
+    """
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        if field.type in ("id", "integer", "bigint") or field.type.startswith(
+            "reference"
+        ):
+            return int(value)
+        elif field.type == "double":
+            return float(value)
+        elif field.type.startswith("decimal"):
+            return Decimal(value)
+        elif field.type == "date":
+            return datetime.date.fromisoformat(value)
+        elif field.type == "datetime":
+            return datetime.datetime.fromisoformat(value)
+        return value
+    except (ValueError, ArithmeticError):
+        return None
+
 
 class DataTablesField:
     def __init__(
@@ -331,6 +849,7 @@ class DataTablesField:
         hide_edit=False,
         control_type=None,
         options=None,
+        search_type=None,
     ):
         """
         a dataholder class holding all the info we need on a field
@@ -342,8 +861,13 @@ class DataTablesField:
         :param editable: is it editable - future
         :param hide_edit: hide this field on an edit - future
         :param control_type: type of control to use for the edit page
-        :param options: misc options - future
+        :param options: choices for an "equals" column filter, a list or a function
+                        returning one, a text input is used without options
+        :param search_type: column filter, None, "equals", "startswith" or "range"
+                            (numeric/date fields, "from,to" with either side optional)
         """
+        if search_type not in (None,) + SEARCH_TYPES:
+            raise ValueError("search_type must be one of %s" % (SEARCH_TYPES,))
         self.name = name
         self.label = label if label else name.upper().replace("_", " ")
         self.sort_sequence = sort_sequence
@@ -352,3 +876,4 @@ class DataTablesField:
         self.hide_edit = hide_edit
         self.control_type = control_type
         self.options = options
+        self.search_type = search_type
@@ -0,0 +1,214 @@
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EARTH_RADIUS = 3958.8  # miles
+MILES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def bounding_box(latitude, longitude, radius):
+    """
+    the latitude/longitude box holding every point within radius of a point
+
+    the box does not wrap around the antimeridian, it is clipped at +/-180
+
+    :param latitude: degrees
+    :param longitude: degrees
+    :param radius: miles
+    :return: (min latitude, max latitude, min longitude, max longitude)
+    """
+    delta_latitude = radius / MILES_PER_DEGREE
+    cos_latitude = math.cos(math.radians(latitude))
+    if cos_latitude * 180 * MILES_PER_DEGREE <= radius:
+        delta_longitude = 180
+    else:
+        delta_longitude = min(180, radius / (MILES_PER_DEGREE * cos_latitude))
+    return (
+        max(-90, latitude - delta_latitude),
+        min(90, latitude + delta_latitude),
+        max(-180, longitude - delta_longitude),
+        min(180, longitude + delta_longitude),
+    )
+
+
+def distances(latitude, longitude, latitudes, longitudes):
+    """
+    great circle (haversine) distances from one point to many, vectorized with numpy
+    when it is installed
+
+    :param latitude: degrees
+    :param longitude: degrees
+    :param latitudes: sequence of degrees
+    :param longitudes: sequence of degrees
+    :return: list of miles
+    """
+    if numpy is not None:
+        lat1 = numpy.radians(latitude)
+        lat2 = numpy.radians(numpy.asarray(latitudes, dtype=float))
+        dlat = lat2 - lat1
+        dlon = numpy.radians(numpy.asarray(longitudes, dtype=float) - longitude)
+        a = (
+            numpy.sin(dlat / 2) ** 2
+            + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon / 2) ** 2
+        )
+        return (2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(a))).tolist()
+
+    lat1 = math.radians(latitude)
+    cos_lat1 = math.cos(lat1)
+    miles = []
+    for lat, lon in zip(latitudes, longitudes):
+        lat2 = math.radians(lat)
+        a = (
+            math.sin((lat2 - lat1) / 2) ** 2
+            + cos_lat1
+            * math.cos(lat2)
+            * math.sin(math.radians(lon - longitude) / 2) ** 2
+        )
+        miles.append(2 * EARTH_RADIUS * math.asin(math.sqrt(a)))
+    return miles
+
+
+class SpatialIndex:
+    def __init__(self, db, tablename, latitude="latitude", longitude="longitude"):
+        """
+        radius and nearest searches on the latitude/longitude of a table
+
+        candidates come from a SQLite R*Tree, "<tablename>_rtree", with a bounding box
+        query, then the exact distances are computed for the candidates only.  the rtree
+        and the triggers keeping it in sync are created by sql(), until then (or on other
+        databases) the box is a range query on the table itself
+
+        :param db: dal reference
+        :param tablename: table with the points
+        :param latitude: name of the latitude field
+        :param longitude: name of the longitude field
+        """
+        self.db = db
+        self.tablename = tablename
+        self.rtree = tablename + "_rtree"
+        self.latitude = latitude
+        self.longitude = longitude
+        #  set once the rtree was found, migrate may create it after the workers start
+        self.rtree_found = False
+
+    def has_rtree(self):
+        if not self.rtree_found and self.db._dbname == "sqlite":
+            self.rtree_found = bool(
+                self.db.executesql(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    placeholders=(self.rtree,),
+                )
+            )
+        return self.rtree_found
+
+    def sql(self):
+        """
+        the statements creating the rtree, the triggers keeping it in sync with the table
+        and loading the existing rows
+
+        the rtree stores the boxes as 32 bit floats, the exact values are read from the table
+
+        :return: list of sql statements, run by migrate
+        """
+        names = dict(
+            rtree=self.rtree,
+            table=self.tablename,
+            lat=self.latitude,
+            lon=self.longitude,
+        )
+        names["values"] = "new.id, new.{lat}, new.{lat}, new.{lon}, new.{lon}".format(
+            **names
+        )
+        names["not_null"] = "new.{lat} IS NOT NULL AND new.{lon} IS NOT NULL".format(
+            **names
+        )
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {rtree} USING rtree"
+            "(id, min_lat, max_lat, min_lon, max_lon);",
+            "CREATE TRIGGER IF NOT EXISTS {rtree}_insert AFTER INSERT ON {table} "
+            "WHEN {not_null} BEGIN INSERT INTO {rtree} VALUES ({values}); END;",
+            "CREATE TRIGGER IF NOT EXISTS {rtree}_update "
+            "AFTER UPDATE OF {lat}, {lon} ON {table} BEGIN "
+            "DELETE FROM {rtree} WHERE id = old.id; "
+            "INSERT INTO {rtree} SELECT {values} WHERE {not_null}; END;",
+            "CREATE TRIGGER IF NOT EXISTS {rtree}_delete AFTER DELETE ON {table} "
+            "BEGIN DELETE FROM {rtree} WHERE id = old.id; END;",
+            "INSERT OR REPLACE INTO {rtree} "
+            "SELECT id, {lat}, {lat}, {lon}, {lon} FROM {table} "
+            "WHERE {lat} IS NOT NULL AND {lon} IS NOT NULL;",
+        ]
+        return [statement.format(**names) for statement in statements]
+
+    def candidates(self, latitude, longitude, radius):
+        """
+        the rows whose point is in the bounding box of the circle, from the rtree when
+        there is one
+
+        :return: (ids, latitudes, longitudes)
+        """
+        box = bounding_box(latitude, longitude, radius)
+        if self.has_rtree():
+            rows = self.db.executesql(
+                "SELECT t.id, t.{lat}, t.{lon} FROM {rtree} r "
+                "JOIN {table} t ON t.id = r.id "
+                "WHERE r.max_lat >= ? AND r.min_lat <= ? "
+                "AND r.max_lon >= ? AND r.min_lon <= ?".format(
+                    rtree=self.rtree,
+                    table=self.tablename,
+                    lat=self.latitude,
+                    lon=self.longitude,
+                ),
+                placeholders=box,
+            )
+        else:
+            table = self.db[self.tablename]
+            lat, lon = table[self.latitude], table[self.longitude]
+            query = (
+                (lat >= box[0]) & (lat <= box[1]) & (lon >= box[2]) & (lon <= box[3])
+            )
+            rows = self.db.executesql(self.db(query)._select(table._id, lat, lon))
+        if not rows:
+            return [], [], []
+        return [list(column) for column in zip(*rows)]
+
+    def within(self, latitude, longitude, radius, limit=None):
+        """
+        the rows within radius miles of a point, nearest first
+
+        :param latitude: degrees
+        :param longitude: degrees
+        :param radius: miles
+        :param limit: return at most limit rows
+        :return: list of (id, miles)
+        """
+        ids, latitudes, longitudes = self.candidates(latitude, longitude, radius)
+        found = [
+            (miles, id)
+            for id, miles in zip(
+                ids, distances(latitude, longitude, latitudes, longitudes)
+            )
+            if miles <= radius
+        ]
+        found.sort()
+        return [(id, miles) for miles, id in found[:limit]]
+
+    def nearest(self, latitude, longitude, count=10, radius=10):
+        """
+        the count rows nearest to a point
+
+        searches within radius miles and doubles the radius until enough rows are found
+
+        :param latitude: degrees
+        :param longitude: degrees
+        :param count: number of rows
+        :param radius: miles of the first search
+        :return: list of (id, miles), nearest first
+        """
+        while True:
+            found = self.within(latitude, longitude, radius, limit=count)
+            if len(found) >= count or radius >= math.pi * EARTH_RADIUS:
+                return found
+            radius *= 2
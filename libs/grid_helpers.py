@@ -1,23 +1,68 @@
+import hashlib
 from functools import reduce
 from urllib.parse import unquote_plus
 
-from py4web import request, Field
+from yatl.helpers import DIV, TD, TR, XML, is_helper, xmlescape
+from py4web import request, response, Field
 from py4web.utils.form import Form, FormStyleBulma
+from pydal.objects import FieldVirtual
+from pydal.validators import IS_NULL_OR, IS_IN_SET
+
+from .metrics import phase
+
+GRID_FRAGMENT_HEADER = "X-Grid-Fragment"
+#  the url values of a checked boolean search
+TRUE_VALUES = ("on", "true", "t", "1", "yes")
+
+
+def is_grid_fragment_request():
+    return request.headers.get(GRID_FRAGMENT_HEADER) == "1"
 
 
 class GridSearchQuery:
-    def __init__(self, name, query, requires=None, datatype="str", default=None):
+    def __init__(
+        self,
+        name,
+        query,
+        requires=None,
+        datatype="str",
+        default=None,
+        widget=None,
+        facet=None,
+    ):
         self.name = name
         self.query = query
         self.requires = requires
         self.datatype = datatype
         self.default = default
+        self.widget = widget
+        #  a field, the options of the search are its values with their counts
+        self.facet = facet
 
         self.field_name = name.replace(" ", "_").lower()
 
 
 class GridSearch:
-    def __init__(self, search_queries, queries=None, target_element=None):
+    def __init__(
+        self,
+        search_queries,
+        queries=None,
+        target_element=None,
+        cache=None,
+        generation=None,
+        expiration=300,
+    ):
+        """
+        a search with a default is applied with it until the url holds a value for it, like
+        an "active only" boolean search checked by default
+
+        :param search_queries: list of GridSearchQuery
+        :param queries: list of queries always applied
+        :param target_element: htmx target of the search form
+        :param cache: cache for the facet counts, None to count on every request
+        :param generation: part of the facet cache key, change it when the data changes
+        :param expiration: seconds to cache the facet counts
+        """
         self.search_queries = search_queries
         self.queries = queries
 
@@ -25,6 +70,7 @@ class GridSearch:
         field_requires = dict()
         field_datatype = dict()
         field_default = dict()
+        field_widget = dict()
         for field in self.search_queries:
             field_name = "sq_" + field.name.replace(" ", "_").replace("/", "_").lower()
             field_names.append(field_name)
@@ -34,11 +80,24 @@ class GridSearch:
                 field_datatype[field_name] = "boolean"
             if field.default:
                 field_default[field_name] = field.default
+            if field.widget:
+                field_widget[field_name] = field.widget
 
         field_values = dict()
         for field in field_names:
             if field in request.query:
                 field_values[field] = unquote_plus(request.query[field])
+                if field in field_datatype:
+                    field_values[field] = field_values[field].lower() in TRUE_VALUES
+            elif field in field_default:
+                #  a search not in the url yet starts with its default, an unchecked
+                #  boolean comes back as "off" and turns its default off
+                field_values[field] = field_default[field]
+
+        if any(sq.facet for sq in self.search_queries):
+            field_requires.update(
+                self.facet_requires(field_values, cache, generation, expiration)
+            )
 
         form_fields = []
         for field in field_names:
@@ -51,10 +110,6 @@ class GridSearch:
 
             if datatype == "boolean":
                 if field_values.get(field):
-                    default = field_values.get(field)
-                else:
-                    default = field_default.get(field)
-                if default:
                     form_fields.append(
                         Field(
                             field,
@@ -82,6 +137,7 @@ class GridSearch:
                         label=label,
                         requires=field_requires.get(field),
                         default=field_values.get(field, field_default.get(field)),
+                        widget=field_widget.get(field),
                         _title=placeholder,
                     )
                 )
@@ -126,6 +182,364 @@ class GridSearch:
 
         self.query = reduce(lambda a, b: (a & b), self.queries)
 
+    def facet_requires(self, field_values, cache=None, generation=None, expiration=300):
+        """
+        validators listing the values of the facet searches with their counts
+
+        one GROUP BY on all the facet fields under the queries and the other searches, the
+        counts of a facet then honour the values picked in the other facets but not its own
+
+        :param field_values: search values by form field name
+        :param cache: cache for the grouped counts
+        :param generation: part of the cache key
+        :param expiration: seconds to cache the grouped counts
+        :return: dict of form field name: IS_NULL_OR(IS_IN_SET(...))
+        """
+        facets = [sq for sq in self.search_queries if sq.facet]
+        names = [
+            "sq_" + sq.name.replace(" ", "_").replace("/", "_").lower() for sq in facets
+        ]
+        fields = [sq.facet for sq in facets]
+        table = fields[0].table
+
+        queries = list(self.queries or [table._id > 0])
+        for sq in self.search_queries:
+            field_name = "sq_" + sq.name.replace(" ", "_").replace("/", "_").lower()
+            if not sq.facet and field_values.get(field_name):
+                queries.append(sq.query(field_values[field_name]))
+        sql = table._db(reduce(lambda a, b: (a & b), queries))._select(
+            *fields, table._id.count(), groupby=reduce(lambda a, b: a | b, fields)
+        )
+        if cache:
+            key = "facets:%s:%s" % (hashlib.sha1(sql.encode()).hexdigest(), generation)
+            groups = cache.get(key, lambda: table._db.executesql(sql), expiration)
+        else:
+            groups = table._db.executesql(sql)
+
+        selected = [field_values.get(name) for name in names]
+        requires = dict()
+        for index, name in enumerate(names):
+            counts = dict()
+            for group in groups:
+                value = group[index]
+                counts.setdefault(value, 0)
+                if all(
+                    not selected[other] or str(group[other]) == selected[other]
+                    for other in range(len(names))
+                    if other != index
+                ):
+                    counts[value] += group[-1]
+            if selected[index]:
+                counts.setdefault(selected[index], 0)
+            requires[name] = IS_NULL_OR(
+                IS_IN_SET(
+                    [
+                        (value, "%s (%d)" % (value, counts[value]))
+                        for value in sorted(v for v in counts if v is not None)
+                    ]
+                )
+            )
+        return requires
+
+
+class LazyGrid:
+    def __init__(
+        self,
+        grid,
+        cache=None,
+        expiration=30,
+        generation=None,
+        enabled=True,
+        compress=None,
+    ):
+        """
+        defer the select of a py4web Grid to a follow-up fragment request
+
+        the first request only renders the page shell - the search form and a placeholder that the
+        browser fills by requesting the same url again with the X-Grid-Fragment header.  the
+        new/details/edit/delete actions are processed as usual.
+
+        :param grid: Grid instance created with auto_process=False
+        :param cache: py4web Cache used to store the rendered fragments
+        :param expiration: seconds to keep a rendered fragment in the cache
+        :param generation: callable returning a value that changes whenever the grid data changes
+        :param enabled: set to False to process and render the grid in a single request
+        :param compress: Compress fixture of the action, the compressed fragments are cached
+                         with the fragments
+        """
+        self.grid = grid
+        self.cache = cache
+        self.expiration = expiration
+        self.generation = generation
+        self.compress = compress
+
+        self.action = grid.path.split("/")[0] or "select"
+        lazy = enabled and self.action == "select"
+        self.fragment = lazy and is_grid_fragment_request()
+        self.shell = lazy and not self.fragment
+
+        if lazy:
+            #  the shell and the fragment share the url
+            response.headers["Vary"] = GRID_FRAGMENT_HEADER
+        if not lazy:
+            grid.process()
+
+    def render_fragment(self):
+        #  the search form is part of the shell
+        self.grid.param.search_form = None
+        self.grid.process()
+        with phase("render"):
+            return str(self.grid.render().xml())
+
+    def render(self):
+        """
+        build the page shell, the table fragment or the grid itself depending on the request
+
+        :return: html representation of the grid or the py4web Form object
+        """
+        if self.shell:
+            shell = DIV()
+            if self.grid.param.search_form:
+                shell.append(
+                    DIV(
+                        self.grid.render_search_form(),
+                        **self.grid.param.grid_class_style.get("grid-header"),
+                    )
+                )
+            shell.append(DIV(_id="grid-fragment", _class="grid-loading"))
+            return shell
+        elif self.fragment:
+            if not self.cache or request.method != "GET":
+                return self.render_fragment()
+            key = "grid-fragment:%s?%s:%s" % (
+                request.fullpath,
+                request.query_string,
+                self.generation() if self.generation else "",
+            )
+            if self.compress:
+                self.compress.cache_as(key)
+            return self.cache.get(key, self.render_fragment, self.expiration)
+
+        return self.grid.render()
+
+
+#  stands for the record id in the compiled action buttons
+ROW_ID_MARKER = "grid-row-id-marker"
+
+
+class CompiledTableBody:
+    def __init__(self, grid):
+        """
+        render the table body of a py4web Grid from strings instead of a helper tree
+
+        Grid.render_table_body builds TR, TD, A and I helpers for every cell and action
+        button of every row, then serializes them.  all that markup only depends on the grid
+        and the request, so it is built once, the buttons with a marker in place of the
+        record id, and every row is the pieces joined with its formatted values - escaped
+        the way yatl does it.
+
+        the first row is also rendered by the Grid and compared, when they differ (a row
+        dependent button, a Grid this was not written for) the Grid renders the body
+
+        install with grid.render_table_body = CompiledTableBody(grid)
+
+        :param grid: Grid instance
+        """
+        self.grid = grid
+        self.render_table_body = grid.render_table_body
+
+    def compilable(self):
+        param = self.grid.param
+        for button in (param.pre_action_buttons or []) + (
+            param.post_action_buttons or []
+        ):
+            if callable(button) or any(
+                callable(value) for value in (button.url, button.additional_classes)
+            ):
+                return False
+        return True
+
+    def compile_columns(self):
+        """
+        :return: list of (field, the opening td tag) of the displayed fields
+        """
+        grid = self.grid
+        classes = grid.param.grid_class_style.classes
+        styles = grid.param.grid_class_style.styles
+        columns = []
+        for field in grid.param.fields:
+            if not field.readable or (field.type == "id" and not grid.param.show_id):
+                continue
+            #  the class and style of Grid.render_field, as it computes them
+            key = "%s.%s" % (field.tablename, field.name)
+            class_type = (
+                "grid-cell-type-%s" % str(field.type).split(":")[0].split("(")[0]
+            )
+            class_col = " grid-col-%s" % key
+            td = TD(
+                _class=(
+                    classes.get("grid-td", "") + " " + class_type
+                    if class_type not in classes.get(class_type, "").split(" ")
+                    else "" + " " + classes.get(class_type, "") + " " + class_col
+                ).strip(),
+                _style=(styles.get(class_type) or styles.get("grid-td")),
+            )
+            columns.append((field, td.xml()[: -len("</td>")]))
+        return columns
+
+    def compile_buttons(self):
+        """
+        :return: the action cell split at the record id, None when the grid has none
+        """
+        grid = self.grid
+        param = grid.param
+        if not (
+            (param.details and param.details != "")
+            or (param.editable and param.editable != "")
+            or (param.deletable and param.deletable != "")
+            or (param.post_action_buttons or param.pre_action_buttons)
+        ):
+            return None
+        classes = param.grid_class_style.classes
+        styles = param.grid_class_style.styles
+        td = TD(
+            _class=(
+                classes.get("grid-td", "") + " " + classes.get("grid-td-action-button")
+            ).strip(),
+            _style=(
+                styles.get("grid-td", "") + " " + styles.get("grid-td-action-button")
+            ).strip(),
+        )
+
+        def custom(button):
+            if button.onclick:
+                button.url = None
+            return grid.render_action_button(
+                button.url,
+                button.text,
+                button.icon,
+                _onclick=button.onclick,
+                additional_classes=button.additional_classes,
+                message=button.message,
+                row_id=ROW_ID_MARKER if button.append_id else None,
+            )
+
+        for button in param.pre_action_buttons or []:
+            td.append(custom(button))
+        for name, default, icon, text in (
+            ("details", "/details", "fa-id-card", param.details_action_button_text),
+            ("editable", "/edit", "fa-edit", param.edit_action_button_text),
+            ("deletable", "/delete", "fa-trash", param.delete_action_button_text),
+        ):
+            value = getattr(param, name)
+            if not value or value == "":
+                continue
+            url = value if isinstance(value, str) else grid.endpoint + default
+            url += "/%s?%s" % (ROW_ID_MARKER, grid.referrer)
+            if name == "deletable":
+                attrs = grid.attributes_plugin.confirm(
+                    message="Are you sure you want to delete?"
+                )
+                td.append(
+                    grid.render_action_button(
+                        url=url,
+                        button_text=text,
+                        icon=icon,
+                        additional_classes="confirmation",
+                        message="Delete record",
+                        name="grid-delete-button",
+                        **attrs,
+                    )
+                )
+            else:
+                td.append(
+                    grid.render_action_button(
+                        url=url,
+                        button_text=text,
+                        icon=icon,
+                        name="grid-%s-button" % default[1:],
+                    )
+                )
+        for button in param.post_action_buttons or []:
+            td.append(custom(button))
+        return td.xml().split(ROW_ID_MARKER)
+
+    def compile(self):
+        """
+        :return: (the opening tr tag, the columns, the action cell split at the record id)
+        """
+        grid = self.grid
+        row_open = TR(
+            _role="row",
+            _class=grid.param.grid_class_style.classes.get("grid-tr"),
+            _style=grid.param.grid_class_style.styles.get("grid-tr"),
+        ).xml()[: -len("</tr>")]
+        columns = [
+            (
+                field,
+                td,
+                isinstance(field, FieldVirtual),
+                formatter,
+                formatter.__code__.co_argcount == 1,
+            )
+            for field, td in self.compile_columns()
+            for formatter in [
+                grid.formatters.get("%s.%s" % (field.tablename, field.name))
+                or grid.formatters_by_type.get(field.type)
+                or grid.formatters_by_type.get("default")
+            ]
+        ]
+        return row_open, columns, self.compile_buttons()
+
+    def render_rows(self, rows, compiled):
+        grid = self.grid
+        row_open, columns, buttons = compiled
+        html = []
+        append = html.append
+        for row in rows:
+            if grid.use_tablename and grid.tablename in row and "id" not in row:
+                row_id = row[grid.tablename]["id"]
+            else:
+                row_id = row["id"]
+                grid.use_tablename = False
+            use_tablename = grid.use_tablename
+
+            append(row_open)
+            for field, td, virtual, formatter, single in columns:
+                if virtual:
+                    value = field.f(row[field.tablename] if use_tablename else row)
+                elif use_tablename:
+                    value = row[field.tablename][field.name]
+                else:
+                    value = row[field.name]
+                content = formatter(value) if single else formatter(value, row)
+                append(td)
+                append(content.xml() if is_helper(content) else xmlescape(str(content)))
+                append("</td>")
+            if buttons:
+                append(xmlescape(str(row_id)).join(buttons))
+            append("</tr>")
+        return "".join(html)
+
+    def __call__(self):
+        grid = self.grid
+        rows = grid.rows
+        if not rows or not self.compilable():
+            return self.render_table_body()
+        compiled = self.compile()
+        use_tablename = grid.use_tablename
+        grid.rows = rows[:1]
+        try:
+            expected = self.render_table_body().xml()
+        finally:
+            grid.rows = rows
+            grid.use_tablename = use_tablename
+        same = expected == "<tbody>%s</tbody>" % self.render_rows(rows[:1], compiled)
+        grid.use_tablename = use_tablename
+        if not same:
+            return self.render_table_body()
+        return XML("<tbody>%s</tbody>" % self.render_rows(rows, compiled))
+
 
 def apply_htmx_attrs(grid, target):
     myattrs = {"_hx-post": request.url, "_hx-target": target, "_hx-swap": "innerHTML"}
@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+
+
+class QueryInterrupted(Exception):
+    def __init__(self, reason):
+        """
+        a statement run under interruptible() was stopped
+
+        :param reason: "budget" when it ran out of time, "cancelled" when cancelled() said so
+        """
+        super().__init__(reason)
+        self.reason = reason
+
+
+@contextmanager
+def interruptible(db, budget=None, cancelled=None, interval=0.05, instructions=1000):
+    """
+    stop the sqlite statements run in the block once they took budget seconds or once
+    cancelled() returns True
+
+    sqlite calls the progress handler of the connection every `instructions` virtual machine
+    steps, a non zero return makes the running statement fail with "interrupted".  the clock
+    is read on every call, cancelled() (which may read a shared store) only every `interval`
+    seconds.  the block runs as is on other databases
+
+    :param db: dal reference, the connection of the current thread is used
+    :param budget: seconds for the whole block, None for no limit
+    :param cancelled: function, True when the result is no longer wanted
+    :param interval: seconds between calls to cancelled()
+    :param instructions: sqlite steps between calls of the progress handler
+    :raises QueryInterrupted: when a statement was stopped
+    """
+    connection = db._adapter.connection
+    if not hasattr(connection, "set_progress_handler"):
+        yield
+        return
+
+    now = time.monotonic()
+    deadline = now + budget if budget else None
+    state = dict(check=now + interval, reason=None)
+
+    def progress():
+        now = time.monotonic()
+        if deadline is not None and now > deadline:
+            state["reason"] = "budget"
+            return 1
+        if cancelled is not None and now > state["check"]:
+            state["check"] = now + interval
+            if cancelled():
+                state["reason"] = "cancelled"
+                return 1
+        return 0
+
+    connection.set_progress_handler(progress, instructions)
+    try:
+        yield
+    except Exception as e:
+        #  db.executesql() returns None when the fetch is interrupted, the block may fail
+        #  on that instead of the sqlite error
+        if state["reason"]:
+            raise QueryInterrupted(state["reason"]) from e
+        raise
+    finally:
+        connection.set_progress_handler(None, instructions)
+    if state["reason"]:
+        raise QueryInterrupted(state["reason"])
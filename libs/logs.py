@@ -0,0 +1,202 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from py4web import request, response
+from py4web.core import Fixture
+
+REQUEST_ID_HEADER = "X-Request-ID"
+#  where the id of a request is kept, in its wsgi environ
+REQUEST_ID_KEY = "simple_table.request_id"
+#  a request id sent by a proxy is used when it looks like one
+VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+
+def request_id():
+    """
+    the correlation id of the current request, set by RequestId as the request starts or
+    else the first time it is asked for
+
+    the X-Request-ID of the request when a proxy sent one, else a new uuid.  the response
+    sends it back in its X-Request-ID
+
+    :return: the id or None outside of a request
+    """
+    try:
+        environ = request.environ
+    except (AttributeError, RuntimeError):
+        return None
+    value = environ.get(REQUEST_ID_KEY)
+    if value is None:
+        value = environ.get("HTTP_X_REQUEST_ID") or ""
+        if not VALID_REQUEST_ID.match(value):
+            value = uuid.uuid4().hex
+        environ[REQUEST_ID_KEY] = value
+        response.headers[REQUEST_ID_HEADER] = value
+    return value
+
+
+class RequestId(Fixture):
+    """
+    gives the request its id as it starts, the response sends it in X-Request-ID whether
+    the request logs anything or not
+    """
+
+    def on_request(self):
+        request_id()
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    adds the request_id of the current request to the records, "-" outside of a request
+
+    runs in the thread that logs, add it to the handler of the logger
+    """
+
+    def filter(self, record):
+        record.request_id = request_id() or "-"
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    one json object per record: time, level, logger, request_id, file, line, message and
+    exception or stack when there is one
+    """
+
+    def format(self, record):
+        data = dict(
+            time=datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            level=record.levelname,
+            logger=record.name,
+            request_id=getattr(record, "request_id", None),
+            file=record.filename,
+            line=record.lineno,
+            message=record.getMessage(),
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+class Buffered:
+    """
+    emit without flushing the stream after every record, LogWriter flushes every batch
+    """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class BufferedStreamHandler(Buffered, logging.StreamHandler):
+    pass
+
+
+class BufferedFileHandler(Buffered, logging.FileHandler):
+    pass
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        """
+        puts the records in the queue of a LogWriter, drops them when it is full
+
+        :param queue: the queue of the LogWriter
+        """
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        #  the message and the traceback are rendered here, the args may change and the
+        #  frames go away once the call returns.  the writer formats the rest
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter:
+    def __init__(self, handlers, size=10000, batch_size=256):
+        """
+        write the records of a logger from a background thread
+
+        the logger gets handler, which only queues the records, and the thread hands them
+        to handlers in batches: all the records queued while it was writing the previous
+        batch, then one flush per handler.  when the queue is full the records are dropped
+        and counted, logging never waits for the disk
+
+        :param handlers: the handlers writing the records, Buffered ones flush per batch
+        :param size: records the queue holds
+        :param batch_size: most records written between two flushes
+        """
+        self.queue = queue.Queue(size)
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.handler = LogQueueHandler(self.queue)
+        self.thread = None
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="log-writer", daemon=True
+            )
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """
+        write the records queued so far and stop the thread
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    break
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.flush()
+            if record is None:
+                return
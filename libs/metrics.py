@@ -0,0 +1,254 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from py4web import request
+from py4web.core import Fixture
+from pydal.helpers.classes import ExecutionHandler
+
+#  seconds, the upper bounds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#  the timer of the request handled by this thread, None between requests
+local = threading.local()
+
+#  mark: the phase that follows it
+NEXT_PHASE = dict(start="setup", setup="handler", handler="render", render="teardown")
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        """
+        counts of the values per fixed bucket, their sum and their count
+
+        :param buckets: sorted upper bounds, +Inf is added
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, prefix="simple_table", buckets=BUCKETS):
+        """
+        the request phase histograms of this worker and the other values it exports
+
+        :param prefix: prefix of the metric names
+        :param buckets: upper bounds of the histogram buckets, seconds
+        """
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms = dict()
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, durations):
+        """
+        :param endpoint: the route of the request
+        :param durations: dict of phase: seconds
+        :return:
+        """
+        with self.lock:
+            for phase, seconds in durations.items():
+                histogram = self.histograms.get((endpoint, phase))
+                if histogram is None:
+                    histogram = self.histograms[(endpoint, phase)] = Histogram(
+                        self.buckets
+                    )
+                histogram.observe(seconds)
+
+    def collector(self, collect):
+        """
+        export more values with the histograms
+
+        :param collect: function returning a list of (name, type, help, samples), samples a
+                        list of (dict of labels, value).  name is prefixed, type is "counter"
+                        or "gauge"
+        :return:
+        """
+        self.collectors.append(collect)
+
+    def prometheus(self):
+        """
+        :return: all the metrics in the prometheus text format
+        """
+        name = "%s_request_phase_seconds" % self.prefix
+        lines = [
+            "# HELP %s Time spent in each phase of a request, by endpoint" % name,
+            "# TYPE %s histogram" % name,
+        ]
+        with self.lock:
+            histograms = sorted(
+                (key, list(h.counts), h.sum, h.count)
+                for key, h in self.histograms.items()
+            )
+        for (endpoint, phase), counts, total, count in histograms:
+            labels = 'endpoint="%s",phase="%s"' % (
+                label_value(endpoint),
+                label_value(phase),
+            )
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                lines.append(
+                    '%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative)
+                )
+            lines.append("%s_sum{%s} %.6f" % (name, labels, total))
+            lines.append("%s_count{%s} %d" % (name, labels, count))
+
+        for collect in self.collectors:
+            for metric, metric_type, help, samples in collect():
+                metric = "%s_%s" % (self.prefix, metric)
+                lines.append("# HELP %s %s" % (metric, help))
+                lines.append("# TYPE %s %s" % (metric, metric_type))
+                for labels, value in samples:
+                    lines.append(
+                        "%s%s %s"
+                        % (
+                            metric,
+                            "{%s}"
+                            % ",".join(
+                                '%s="%s"' % (key, label_value(value))
+                                for key, value in sorted(labels.items())
+                            )
+                            if labels
+                            else "",
+                            value,
+                        )
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class QueryTimer(ExecutionHandler):
+    """
+    adds the time of every sql statement run by the thread of a timed request to its
+    timer, append it to db._adapter.execution_handlers
+    """
+
+    def before_execute(self, command):
+        self.start = time.perf_counter()
+
+    def after_execute(self, command):
+        timer = getattr(local, "timer", None)
+        if timer is not None:
+            timer["query"] += time.perf_counter() - self.start
+
+
+@contextmanager
+def phase(name):
+    """
+    time a block as a phase of the current request, less the sql it runs (see QueryTimer)
+
+    does nothing outside of a timed request
+
+    :param name: "render", "serialize"...
+    """
+    timer = getattr(local, "timer", None)
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    query = timer["query"]
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start - (timer["query"] - query)
+        timer["phases"][name] = timer["phases"].get(name, 0.0) + elapsed
+        timer["timed"] += elapsed
+
+
+class Timing(Fixture):
+    def __init__(self, metrics, enabled=True, prerequisites=()):
+        """
+        record how long the phases of a request take into metrics
+
+        list it first in action.uses and timing.end last, the phases are then
+            setup       the on_request of the other fixtures (session, auth...)
+            handler     the action itself, less its sql and its timed blocks
+            render      the transforms of the other fixtures, the template
+            teardown    their on_success, the commit
+            query       the sql run by the thread of the request
+            total       the whole request
+        and the blocks timed with phase(), like "render" and "serialize"
+
+        :param metrics: Metrics
+        :param enabled: set to False to record nothing
+        :param prerequisites: fixtures the actions using timing get too, ahead of it
+        """
+        self.__prerequisites__ = list(prerequisites)
+        self.metrics = metrics
+        self.enabled = enabled
+        self.end = TimingEnd(self)
+
+    def mark(self, name):
+        timer = getattr(local, "timer", None)
+        if timer is not None:
+            timer["marks"].append(
+                (name, time.perf_counter(), timer["query"] + timer["timed"])
+            )
+
+    def on_request(self):
+        local.timer = None
+        if self.enabled:
+            local.timer = dict(query=0.0, timed=0.0, phases=dict(), marks=[])
+            self.mark("start")
+
+    def transform(self, output, shared_data=None):
+        self.mark("handler")
+        return output
+
+    def finish(self):
+        timer = getattr(local, "timer", None)
+        if timer is None:
+            return
+        self.mark("end")
+        local.timer = None
+
+        marks = timer["marks"]
+        durations = dict(timer["phases"])
+        #  each mark ends the phase it names, less the sql and the timed blocks in it, the
+        #  last one ends the phase after the previous mark, cut short by an error or a redirect
+        for (previous, start, excluded), (name, end, total) in zip(marks, marks[1:]):
+            if name == "end":
+                name = NEXT_PHASE[previous]
+            durations[name] = durations.get(name, 0.0) + max(
+                0.0, end - start - (total - excluded)
+            )
+        durations["query"] = timer["query"]
+        durations["total"] = marks[-1][1] - marks[0][1]
+        #  request.route raises outside of a route (actions called by scripts)
+        route = request.environ.get("bottle.route")
+        route = route.rule if route else request.path
+        self.metrics.observe(route.replace("<:re:/?>", ""), durations)
+
+
+class TimingEnd(Fixture):
+    def __init__(self, timing):
+        """
+        the end of the phases of Timing, list it last in action.uses
+        """
+        self.timing = timing
+
+    def on_request(self):
+        self.timing.mark("setup")
+
+    def transform(self, output, shared_data=None):
+        self.timing.mark("render")
+        return output
+
+    def on_success(self, status):
+        self.timing.finish()
+
+    def on_error(self):
+        self.timing.finish()
@@ -0,0 +1,41 @@
+from py4web import Session
+
+
+class LazySession(Session):
+    """
+    Session that only decodes the cookie (or reads the storage) the first time it is used
+
+    requests that never touch the session pay nothing, and a visitor without a cookie is
+    only sent one once something is stored in the session.  as with Session, the cookie
+    is only signed again when the data changed.
+    """
+
+    def on_request(self):
+        self.local.loaded = False
+        self.local.changed = False
+        self.local.data = {}
+
+    def load(self):
+        self.local.loaded = True
+        super().load()
+        #  a new session holds nothing worth a cookie yet
+        if set(self.local.data) <= {"uuid", "secure"}:
+            self.local.changed = False
+
+    def get_data(self):
+        if not getattr(self.local, "loaded", True):
+            self.load()
+        return super().get_data()
+
+    def __setitem__(self, key, value):
+        self.get_data()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.get_data()
+        super().__delitem__(key)
+
+    def clear(self):
+        if not getattr(self.local, "loaded", True):
+            self.load()
+        super().clear()
@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+from pydal.objects import Expression
+
+#  dbapi paramstyle: placeholder
+PLACEHOLDERS = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+
+
+class StatementCache:
+    def __init__(self, db, size=500):
+        """
+        the sql of a query shape compiled once, then run with the values bound
+
+        a shape is all that changes the sql - the tables, the columns filtered and their
+        operators, the order, the columns selected - but not the values.  the query of a
+        shape is built with parameter in place of every value, its sql kept under the shape
+        and every call binds its own values, in the order of the parameters in the sql.
+        the driver then sees the same text for every call of a shape, so the prepared
+        statement cache of the connection (128 statements for sqlite3) gets hits as well
+
+        enabled is False for drivers with a named or numeric paramstyle
+
+        :param db: dal reference
+        :param size: shapes to keep, least recently used dropped first
+        """
+        self.db = db
+        self.size = size
+        self.statements = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        paramstyle = getattr(db._adapter.driver, "paramstyle", None)
+        self.placeholder = PLACEHOLDERS.get(paramstyle)
+        self.parameter = Expression(db, self.placeholder) if self.placeholder else None
+
+    @property
+    def enabled(self):
+        return self.placeholder is not None
+
+    def get(self, shape, build):
+        """
+        :param shape: hashable key of the statements
+        :param build: function returning the sql of the shape, called on the first use
+        :return: what build returned
+        """
+        with self.lock:
+            sql = self.statements.get(shape)
+            if sql is not None:
+                self.statements.move_to_end(shape)
+                self.hits += 1
+                return sql
+            self.misses += 1
+        #  built outside the lock, two threads may build the same shape once each
+        sql = build()
+        with self.lock:
+            self.statements[shape] = sql
+            while len(self.statements) > self.size:
+                self.statements.popitem(last=False)
+        return sql
+
+    def limit(self, sql):
+        """
+        :param sql: a select without limitby
+        :return: the select with a LIMIT and an OFFSET to bind after its other values
+        """
+        return "%s LIMIT %s OFFSET %s" % (
+            sql.rstrip().rstrip(";"),
+            self.placeholder,
+            self.placeholder,
+        )
+
+
+def like_pattern(value):
+    """
+    the value of field.contains(value) for a LOWER(field) LIKE parameter ESCAPE '\\'
+
+    :param value: the text searched
+    :return: %value% lower case, with \\, % and _ escaped
+    """
+    value = value.lower().replace("\\", "\\\\")
+    return "%" + value.replace("%", "\\%").replace("_", "\\_") + "%"
@@ -1,6 +1,92 @@
-from pydal.validators import IS_DATE
+import re
+
+from pydal.validators import IS_DATE, Validator, ValidationError
 
 
 class IS_DATE_HTML5(IS_DATE):
     def __init__(self, error_message="Enter a valid Date"):
         super().__init__(error_message=error_message)
+
+
+class IS_IN_DB_LOOKUP(Validator):
+    REGEX_LABEL_FIELD = r"%\((\w+)\)"
+
+    def __init__(
+        self,
+        dbset,
+        field,
+        label,
+        page_size=20,
+        error_message="Value not in database",
+    ):
+        """
+        IS_IN_DB for large tables, it has no options so forms do not render a select with
+        every row.  use with LookupWidget, the lookup action pages through lookup() as the
+        user types
+
+        :param dbset: dal reference or a Set limiting the rows
+        :param field: the referenced field, "table.id"
+        :param label: format of a row, "%(last_name)s, %(first_name)s" - the typed text
+                      is a prefix of the first field, rows are ordered by the label fields
+        :param page_size: rows per lookup page
+        :param error_message: message when the value is not in the table
+        """
+        self.dbset = dbset() if hasattr(dbset, "define_table") else dbset
+        self.ktable, self.kfield = field.split(".")
+        self.label = label
+        self.fieldnames = re.findall(self.REGEX_LABEL_FIELD, label)
+        self.page_size = page_size
+        self.error_message = error_message
+
+    def validate(self, value, record_id=None):
+        field = self.dbset.db[self.ktable][self.kfield]
+        if field.type in ("id", "integer") and not str(value).isdigit():
+            raise ValidationError(self.translator(self.error_message))
+        if self.dbset(field == value).count() != 1:
+            raise ValidationError(self.translator(self.error_message))
+        return value
+
+    def fields(self):
+        table = self.dbset.db[self.ktable]
+        return [table[self.kfield]] + [table[name] for name in self.fieldnames]
+
+    def label_for(self, value):
+        """
+        :param value: the stored value
+        :return: the label of the row, "" when there is none
+        """
+        field = self.dbset.db[self.ktable][self.kfield]
+        if value in (None, "") or (
+            field.type in ("id", "integer") and not str(value).isdigit()
+        ):
+            return ""
+        row = self.dbset(field == value).select(*self.fields()).first()
+        return self.label % row if row else ""
+
+    def lookup(self, text, page=0):
+        """
+        one page of the rows whose first label field starts with text, case insensitive
+
+        the query is a range on lower(field), an index on the lower() of the label fields
+        answers it in order without reading the other rows
+
+        :param text: the typed text
+        :param page: page number, from 0
+        :return: (list of (value, label), True when there are more pages)
+        """
+        table = self.dbset.db[self.ktable]
+        search = table[self.fieldnames[0]].lower()
+        query = table[self.kfield] != None
+        text = text.lower()
+        if text:
+            upper = text[:-1] + chr(ord(text[-1]) + 1)
+            query &= (search >= text) & (search < upper)
+        orderby = [table[name].lower() for name in self.fieldnames] + [table._id]
+        rows = self.dbset(query).select(
+            *self.fields(),
+            orderby=orderby,
+            limitby=(page * self.page_size, (page + 1) * self.page_size + 1),
+            cacheable=True,
+        )
+        options = [(row[self.kfield], self.label % row) for row in rows]
+        return options[: self.page_size], len(options) > self.page_size
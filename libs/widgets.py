@@ -0,0 +1,48 @@
+from yatl.helpers import DIV, INPUT
+from py4web import URL
+
+
+class LookupWidget:
+    def __init__(self, field, placeholder="Type to search"):
+        """
+        typeahead for a reference field validated by IS_IN_DB_LOOKUP
+
+        renders a hidden input with the value and a text input, static/js/lookup.js asks the
+        lookup action for the matching rows as the user types.  the widget can be used on
+        other fields too (search forms), the lookups always go through field
+
+        :param field: the dal field whose IS_IN_DB_LOOKUP serves the lookups
+        :param placeholder: placeholder of the text input
+        """
+        self.field = field
+        self.placeholder = placeholder
+
+    def validator(self):
+        requires = self.field.requires
+        #  unwrap IS_NULL_OR
+        return getattr(requires, "other", requires)
+
+    def __call__(self, table, value):
+        #  the form only passes the table, find the field this widget was given to
+        name = next(field.name for field in table if field.widget is self)
+        label = self.validator().label_for(value)
+        #  the form style writes the field attributes over the outer element of a widget
+        return DIV(
+            DIV(
+                #  like a select without a matching option, a value without a row is dropped
+                INPUT(_type="hidden", _name=name, _value=value if label else ""),
+                DIV(
+                    INPUT(
+                        _type="text",
+                        _class="input",
+                        _value=label,
+                        _placeholder=self.placeholder,
+                        _autocomplete="off",
+                    ),
+                    _class="dropdown-trigger",
+                ),
+                DIV(DIV(_class="dropdown-content"), _class="dropdown-menu"),
+                _class="dropdown lookup",
+                **{"_data-url": URL("lookup", self.field.tablename, self.field.name)},
+            )
+        )
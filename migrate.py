@@ -0,0 +1,47 @@
+"""
+Explicit schema migration for the app
+
+Workers started with DB_MIGRATE = False never check or alter the schema, so run this
+once per deploy, from the folder that contains apps/:
+
+    python -m apps.simple_table.migrate
+    python -m apps.simple_table.migrate --fake   # rebuild the .table files only
+"""
+import argparse
+
+from . import settings
+from .common import db
+from .models import EMPLOYEE_FULLNAME, INDEXES, change_log, zip_code_locations
+
+
+def migrate(fake_migrate=False):
+    """
+    create/alter every table defined by the app and create the indexes
+
+    :param fake_migrate: only rebuild the pydal .table migration files
+    :return: list of the migrated table names
+    """
+    for tablename in db.tables:
+        #  what lazy_define_table does when the DAL is created with migrate=True
+        db._adapter.create_table(db[tablename], migrate=True, fake_migrate=fake_migrate)
+    if not fake_migrate:
+        for sql in INDEXES:
+            db.executesql(sql)
+        if db._dbname == "sqlite":
+            for sql in EMPLOYEE_FULLNAME + zip_code_locations.sql() + change_log.sql():
+                db.executesql(sql)
+    db.commit()
+    return list(db.tables)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--fake",
+        action="store_true",
+        default=settings.DB_FAKE_MIGRATE,
+        help="only rebuild the .table files, the tables already exist",
+    )
+    args = parser.parse_args()
+    for tablename in migrate(fake_migrate=args.fake):
+        print("migrated %s" % tablename)
@@ -2,9 +2,30 @@
 This file defines the database models
 """
 
-from .common import db, Field
+from .common import db, cache, Field
+from .libs.change_log import ChangeLog
+from .libs.columnar import ColumnStore
+from .libs.geo import SpatialIndex
+from .libs.validators import IS_IN_DB_LOOKUP
+from .libs.widgets import LookupWidget
 from pydal.validators import *
 
+#  in-memory copy of the datatables columns, see DATATABLES_COLUMNAR in settings.py
+zip_code_columns = ColumnStore(
+    db,
+    "zip_code",
+    ["zip_code", "zip_type", "state", "county", "primary_city"],
+    generation=lambda: cache.generation("zip_code"),
+)
+
+
+def zip_code_on_define(table):
+    cache.track_writes(table, committed=zip_code_columns.committed)
+    zip_code_columns.track_writes(table)
+
+
+db.after_rollback(zip_code_columns.rollback)
+
 
 db.define_table(
     "zip_code",
@@ -25,16 +46,29 @@ db.define_table(
     Field("latitude", "decimal(5,2)"),
     Field("longitude", "decimal(5,2)"),
     format="%(zip_code)s",
+    on_define=zip_code_on_define,
 )
 
-db.executesql("CREATE INDEX IF NOT EXISTS zip_code__idx ON zip_code (zip_code);")
-db.executesql(
-    "CREATE INDEX IF NOT EXISTS zip_code_2__idx ON zip_code (zip_code, county, primary_city);"
-)
+db.define_table("company", Field("name", length=50), on_define=cache.track_writes)
 
-db.define_table("company", Field("name", length=50))
+db.define_table("department", Field("name", length=50), on_define=cache.track_writes)
+
+
+def employee_fullname(row):
+    """
+    the stored employee.fullname, the same as EMPLOYEE_FULLNAME_SQL
+
+    raises KeyError when an update does not set both names, the trigger computes it then
+    """
+    return ("%s %s" % (row["first_name"] or "", row["last_name"] or "")).strip(" ")
+
+
+def employee_on_define(table):
+    cache.track_writes(table)
+    #  typeaheads instead of selects holding every employee/company/department
+    for name in ("supervisor", "company", "department"):
+        table[name].widget = LookupWidget(table[name])
 
-db.define_table("department", Field("name", length=50))
 
 db.define_table(
     "employee",
@@ -54,24 +88,135 @@ db.define_table(
         "supervisor",
         "reference employee",
         requires=IS_NULL_OR(
-            IS_IN_DB(db, "employee.id", "%(last_name)s, %(first_name)s", zero="..")
+            IS_IN_DB_LOOKUP(db, "employee.id", "%(last_name)s, %(first_name)s")
         ),
-        filter_out=lambda x: "%s %s" % (x.first_name, x.last_name) if x else "",
+        filter_out=lambda x: x.fullname if x else "",
     ),
     Field(
         "company",
         "reference company",
-        requires=IS_NULL_OR(IS_IN_DB(db, "company.id", "%(name)s", zero="..")),
+        requires=IS_NULL_OR(IS_IN_DB_LOOKUP(db, "company.id", "%(name)s")),
     ),
     Field(
         "department",
         "reference department",
-        requires=IS_NULL_OR(IS_IN_DB(db, "department.id", "%(name)s", zero="..")),
+        requires=IS_NULL_OR(IS_IN_DB_LOOKUP(db, "department.id", "%(name)s")),
+    ),
+    #  stored so it can be indexed, searched and sorted in sql.  computed by the dal on
+    #  insert and kept right by the EMPLOYEE_FULLNAME triggers on any other write
+    Field(
+        "fullname",
+        length=101,
+        label="Name",
+        writable=False,
+        compute=employee_fullname,
     ),
-    Field.Virtual("fullname", lambda x: f"{x['first_name']} {x['last_name']}"),
     Field("hired", "date", requires=IS_NULL_OR(IS_DATE())),
     Field("active", "boolean", default=False),
+    on_define=employee_on_define,
 )
 
+# created by migrate.py, not at import
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS zip_code__idx ON zip_code (zip_code);",
+    #  covering indexes: the datatables page (zip_code order) and the grid (default order)
+    #  are read from the index alone, rowid is part of every SQLite index
+    "DROP INDEX IF EXISTS zip_code_2__idx;",
+    "CREATE INDEX IF NOT EXISTS zip_code_list__idx "
+    "ON zip_code (zip_code, zip_type, state, county, primary_city);",
+    "CREATE INDEX IF NOT EXISTS zip_code_grid__idx "
+    "ON zip_code (state DESC, county, primary_city, zip_code, zip_type);",
+    #  datatables column filters, equality on state/zip_type then in zip_code order
+    "CREATE INDEX IF NOT EXISTS zip_code_state__idx ON zip_code (state, zip_code);",
+    "CREATE INDEX IF NOT EXISTS zip_code_type__idx ON zip_code (zip_type, zip_code);",
+    #  IS_IN_DB_LOOKUP prefix searches, in label order
+    "CREATE INDEX IF NOT EXISTS employee_lookup__idx "
+    "ON employee (lower(last_name), lower(first_name));",
+    #  employee grid, sort by name and name search (prefix of lower(fullname))
+    "CREATE INDEX IF NOT EXISTS employee_fullname__idx ON employee (fullname);",
+    "CREATE INDEX IF NOT EXISTS employee_fullname_lower__idx "
+    "ON employee (lower(fullname));",
+    #  the employee grid opens on the active employees, a fraction of the table: partial
+    #  indexes on them in the grid order, alone and under a company or department search
+    "CREATE INDEX IF NOT EXISTS employee_active__idx "
+    "ON employee (last_name, first_name) WHERE active = 'T';",
+    "CREATE INDEX IF NOT EXISTS employee_active_company__idx "
+    "ON employee (company, last_name, first_name) WHERE active = 'T';",
+    "CREATE INDEX IF NOT EXISTS employee_active_department__idx "
+    "ON employee (department, last_name, first_name) WHERE active = 'T';",
+    "CREATE INDEX IF NOT EXISTS company_lookup__idx ON company (lower(name));",
+    "CREATE INDEX IF NOT EXISTS department_lookup__idx ON department (lower(name));",
+]
 
-db.commit()
+EMPLOYEE_FULLNAME_SQL = (
+    "trim(coalesce({row}.first_name, '') || ' ' || coalesce({row}.last_name, ''))"
+)
+
+#  sqlite only, created by migrate.py: fill employee.fullname for the existing rows and keep
+#  it right for updates of one name and writes outside the dal
+EMPLOYEE_FULLNAME = [
+    "UPDATE employee SET fullname = {expr} "
+    "WHERE fullname IS NOT {expr};".format(
+        expr=EMPLOYEE_FULLNAME_SQL.format(row="employee")
+    ),
+    "CREATE TRIGGER IF NOT EXISTS employee_fullname_insert AFTER INSERT ON employee "
+    "WHEN new.fullname IS NOT {expr} BEGIN "
+    "UPDATE employee SET fullname = {expr} WHERE id = new.id; END;".format(
+        expr=EMPLOYEE_FULLNAME_SQL.format(row="new")
+    ),
+    "CREATE TRIGGER IF NOT EXISTS employee_fullname_update "
+    "AFTER UPDATE OF first_name, last_name, fullname ON employee "
+    "WHEN new.fullname IS NOT {expr} BEGIN "
+    "UPDATE employee SET fullname = {expr} WHERE id = new.id; END;".format(
+        expr=EMPLOYEE_FULLNAME_SQL.format(row="new")
+    ),
+]
+
+#  set once employee.fullname was found filled in this process
+fullname_backfilled = False
+
+
+def backfill_employee_fullname():
+    """
+    fill employee.fullname where it is NULL, checked once per process
+
+    the rows written before the column existed have none.  migrate.py fills them with its
+    triggers, this covers the databases it never ran on (DB_MIGRATE = True in development).
+    call it in a request using db, the update is committed with it
+    """
+    global fullname_backfilled
+    if fullname_backfilled:
+        return
+    if not db(db.employee.fullname == None).isempty():
+        db.executesql(
+            "UPDATE employee SET fullname = {expr} WHERE fullname IS NULL;".format(
+                expr=EMPLOYEE_FULLNAME_SQL.format(row="employee")
+            )
+        )
+        #  raw sql, the dal callbacks of track_writes do not see it
+        cache.wrote("employee")
+    fullname_backfilled = True
+
+
+#  radius and nearest searches on the zip code coordinates, the rtree and its triggers
+#  are created by migrate.py (sqlite only)
+zip_code_locations = SpatialIndex(db, "zip_code")
+
+#  change feed of the tables for clients keeping a copy, the log and its triggers are
+#  created by migrate.py (sqlite only).  the feed sends the fields the grids show
+change_log = ChangeLog(
+    db,
+    dict(
+        zip_code=["zip_code", "zip_type", "state", "county", "primary_city"],
+        employee=[
+            "fullname",
+            "company",
+            "department",
+            "hired",
+            "supervisor",
+            "active",
+        ],
+        company=["name"],
+        department=["name"],
+    ),
+)
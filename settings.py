@@ -15,6 +15,13 @@ APP_NAME = os.path.split(APP_FOLDER)[-1]
 DB_FOLDER = os.path.join(APP_FOLDER, "databases")
 DB_URI = "sqlite://storage.db"
 DB_POOL_SIZE = 1
+# DB_MIGRATE:   let pydal create/alter tables the first time they are used.  Set to
+#               False in production and run "python -m apps.simple_table.migrate"
+#               once per deploy, workers then never touch the schema
+DB_MIGRATE = True
+DB_FAKE_MIGRATE = False
+# DB_LAZY_TABLES: define tables on first use instead of at import
+DB_LAZY_TABLES = True
 
 # location where to store uploaded files:
 UPLOAD_PATH = os.path.join(APP_FOLDER, "uploads")
@@ -36,11 +43,21 @@ SESSION_TYPE = "cookies"
 SESSION_SECRET_KEY = "<my secret key>"
 MEMCACHE_CLIENTS = ["127.0.0.1:11211"]
 REDIS_SERVER = "localhost:6379"
+# READ_ONLY_SKIP_SESSION: anonymous read-only data endpoints (datatables_data) run
+#                         without the session and auth fixtures
+READ_ONLY_SKIP_SESSION = True
 
 # logger settings
 LOGGERS = [
     "warning:stdout"
 ]  # syntax "severity:filename" filename can be stderr or stdout
+# LOG_FORMAT: "text" or "json", one object per line, both carry the request id (X-Request-ID)
+LOG_FORMAT = "text"
+# LOG_QUEUE: the requests only queue their records, a background thread writes them and flushes
+#            once per batch of LOG_BATCH_SIZE, records past LOG_QUEUE_SIZE waiting are dropped
+LOG_QUEUE = True
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
 
 # single sign on Google (will be used if provided)
 OAUTH2GOOGLE_CLIENT_ID = None
@@ -61,6 +78,101 @@ LDAP_SETTINGS = {
     "base_dn": "ou=Users,dc=domain,dc=com",
 }
 
+# cache settings
+# CACHE_TYPE:   "memory" - per worker process
+#               "sqlite" - shared by all the workers on this box
+#               "redis"  - shared by all the workers using REDIS_SERVER
+CACHE_TYPE = "memory"
+CACHE_SIZE = 1000
+CACHE_SQLITE_FILE = os.path.join(DB_FOLDER, "cache.db")
+
+# grid settings
+# GRID_LAZY_LOAD:   render the grid page shell and search form right away and load
+#                   the table body with a follow-up fragment request
+GRID_LAZY_LOAD = True
+GRID_LOOKUP_CACHE_EXPIRATION = 3600  # seconds, distinct values for the dropdowns
+GRID_FRAGMENT_CACHE_EXPIRATION = 30  # seconds, rendered table body fragments
+# GRID_COMPILED_BODY: render the rows of the zip code and employee grids from markup built once
+#                     per grid instead of a helper tree per cell, the html is the same
+GRID_COMPILED_BODY = True
+
+# response settings
+# COMPRESS_RESPONSES: gzip (brotli when installed) the pages and the json of the app for the
+#                     browsers that accept it, outputs under COMPRESS_MIN_SIZE bytes go as is
+COMPRESS_RESPONSES = True
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+# STATIC_ASSETS: static/css and static/js under versioned urls, cached by the browsers for a
+#                year and sent precompressed (python -m apps.simple_table.build_static)
+STATIC_ASSETS = True
+# REQUEST_TIMING: time the phases of the requests (fixtures, sql, render, serialization) into
+#                 histograms per endpoint, exported by the metrics action for prometheus
+REQUEST_TIMING = True
+REQUEST_TIMING_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+# METRICS_TOKEN: the metrics action answers requests sending "Authorization: Bearer <token>"
+#                (bearer_token in the prometheus scrape config), None for none
+# METRICS_ALLOWED_IPS: and the requests from these addresses, the others get a 403.  behind
+#                      a proxy REMOTE_ADDR is the address of the proxy
+METRICS_TOKEN = None
+METRICS_ALLOWED_IPS = ("127.0.0.1", "::1")
+
+# datatables settings
+# DATATABLES_SNAPSHOTS: keep the ordered ids of a filtered search in the cache and serve the
+#                       next pages by id instead of running the search again.  the writes
+#                       outside the dal drop them only once migrate created the change log
+DATATABLES_SNAPSHOTS = True
+DATATABLES_SNAPSHOT_EXPIRATION = 300  # seconds, writes to the table drop them sooner
+DATATABLES_SNAPSHOT_MAX_ROWS = 50000  # bigger results are paged with the search
+# DATATABLES_COLUMNAR: answer zip code searches, sorts and pages from an in-memory columnar
+#                      copy of the table (models.zip_code_columns) instead of the sql path
+#                      (snapshots, cancellation, parallel reads, single flight, compiled
+#                      statements), range filters still go to the database.  costs a few MB
+#                      per worker, faster with numpy.  it only sees the writes of the dal
+DATATABLES_COLUMNAR = False
+# DATATABLES_QUERY_BUDGET: seconds the queries of a data call may run (sqlite), longer
+#                          searches are stopped and the table shows an error
+DATATABLES_QUERY_BUDGET = 2.0
+# DATATABLES_CANCEL_SUPERSEDED: stop the queries of a draw once the same table sent a newer one
+DATATABLES_CANCEL_SUPERSEDED = True
+# DATATABLES_PARALLEL_QUERIES: run the counts and the page of a data call at the same time on
+#                              DATATABLES_READ_POOL_SIZE connections per worker (sqlite,
+#                              once migrate.py created the change log)
+DATATABLES_PARALLEL_QUERIES = True
+DATATABLES_READ_POOL_SIZE = 6
+# DATATABLES_EMBED_FIRST_PAGE: send the first page of the table, sorted and searched like the
+#                             saved state, with the page instead of a data call after it
+DATATABLES_EMBED_FIRST_PAGE = True
+# DATATABLES_SINGLE_FLIGHT: identical data calls running at the same time in a worker share
+#                          one run of their queries (the cache does the same for its misses)
+DATATABLES_SINGLE_FLIGHT = True
+# DATATABLES_COMPILED_STATEMENTS: compile the sql of every shape of data call (filters, search,
+#                                order) once and bind the values, STATEMENT_CACHE_SIZE shapes kept
+DATATABLES_COMPILED_STATEMENTS = True
+STATEMENT_CACHE_SIZE = 500
+# DATATABLES_PIPELINE_PAGES: pages of the table per data call, the browser keeps them for
+#                            DATATABLES_PIPELINE_MAX_AGE seconds, draws them without a call
+#                            and prefetches the pages next to the one shown.  1 for none
+DATATABLES_PIPELINE_PAGES = 5
+DATATABLES_PIPELINE_MAX_AGE = 30
+
+# async endpoint settings (asgi.py)
+# ASYNC_DB_POOL_SIZE: db threads/connections, the most queries running at the same time
+ASYNC_DB_POOL_SIZE = 8
+
 # i18n settings
 T_FOLDER = os.path.join(APP_FOLDER, "translations")
 
@@ -0,0 +1,80 @@
+"use strict";
+
+// typeahead for the LookupWidget: div.lookup[data-url] holding a hidden input with the
+// value, a text input and a dropdown menu filled from the lookup action as the user types.
+// events are delegated from the document so widgets inserted later work too.
+(function () {
+    var timers = new WeakMap();
+    var requests = new WeakMap();
+
+    function fetch_page(div, page, append) {
+        var text = div.querySelector("input[type=text]").value;
+        var url = new URL(div.getAttribute("data-url"), window.location.href);
+        url.searchParams.set("q", text);
+        url.searchParams.set("page", page);
+        var request = (requests.get(div) || 0) + 1;
+        requests.set(div, request);
+        fetch(url, {credentials: "same-origin"})
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                // a newer request was sent while this one was running
+                if (requests.get(div) !== request) return;
+                var content = div.querySelector(".dropdown-content");
+                if (!append) content.innerHTML = "";
+                data.results.forEach(function (result) {
+                    var item = document.createElement("a");
+                    item.className = "dropdown-item";
+                    item.textContent = result.label;
+                    item.setAttribute("data-id", result.id);
+                    content.appendChild(item);
+                });
+                if (data.more) {
+                    var more = document.createElement("a");
+                    more.className = "dropdown-item lookup-more has-text-grey";
+                    more.textContent = "more...";
+                    more.setAttribute("data-page", page + 1);
+                    content.appendChild(more);
+                }
+                div.classList.toggle("is-active", content.children.length > 0);
+            });
+    }
+
+    document.addEventListener("input", function (e) {
+        var div = e.target.closest(".lookup");
+        if (!div) return;
+        // the value is only set by picking a row
+        div.querySelector("input[type=hidden]").value = "";
+        clearTimeout(timers.get(div));
+        timers.set(div, setTimeout(function () { fetch_page(div, 0, false); }, 250));
+    });
+
+    document.addEventListener("focusin", function (e) {
+        var div = e.target.closest(".lookup");
+        if (div && e.target.type === "text") fetch_page(div, 0, false);
+    });
+
+    document.addEventListener("mousedown", function (e) {
+        var item = e.target.closest(".lookup .dropdown-item");
+        if (!item) return;
+        // keep the focus in the text input
+        e.preventDefault();
+        var div = item.closest(".lookup");
+        if (item.classList.contains("lookup-more")) {
+            var page = parseInt(item.getAttribute("data-page"));
+            item.remove();
+            fetch_page(div, page, true);
+            return;
+        }
+        div.querySelector("input[type=hidden]").value = item.getAttribute("data-id");
+        div.querySelector("input[type=text]").value = item.textContent;
+        div.classList.remove("is-active");
+    });
+
+    document.addEventListener("focusout", function (e) {
+        var div = e.target.closest(".lookup");
+        if (!div) return;
+        div.classList.remove("is-active");
+        // typed text that was not picked is not a value
+        if (!div.querySelector("input[type=hidden]").value) e.target.value = "";
+    });
+})();
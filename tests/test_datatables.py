@@ -0,0 +1,142 @@
+"""
+The zip code datatables data path against the plain dal query
+
+Run from the folder that contains apps/, on the sample database:
+
+    python -m unittest apps.simple_table.tests.test_datatables
+
+the rows written by the tests have state ZZ/YY and are deleted at the end
+"""
+import unittest
+from unittest import mock
+
+from .. import settings
+from ..benchmarks.columnar_datatables import get_vars
+from ..common import db, cache
+from ..controllers import (
+    zip_code_columnar,
+    zip_code_datatables_query,
+    zip_code_datatables_request,
+    zip_code_sql,
+)
+from ..models import change_log
+
+#  the sql path with each of its layers on and off
+SQL_SETTINGS = [
+    dict(
+        DATATABLES_SNAPSHOTS=snapshots,
+        DATATABLES_PARALLEL_QUERIES=parallel,
+        DATATABLES_COMPILED_STATEMENTS=compiled,
+    )
+    for snapshots in (True, False)
+    for parallel in (True, False)
+    for compiled in (True, False)
+]
+
+REQUESTS = dict(
+    first_page=get_vars(),
+    last_pages=get_vars(start=15000),
+    state_desc=get_vars(order=[(3, "desc")], start=300),
+    city_county=get_vars(order=[(5, "asc"), (4, "desc")], start=45),
+    state_filter=get_vars(filters=dict(state="WA")),
+    all_rows=get_vars(filters=dict(state="WA"), length=-1),
+    zip_code_prefix=get_vars(filters=dict(zip_code="98"), order=[(2, "asc")], start=10),
+    search=get_vars("ity1"),
+    search_county_desc=get_vars("Co", order=[(4, "desc")], start=30),
+)
+
+
+def expected(dtr):
+    """
+    the response of a data call from the plain dal query, ties broken by id
+    """
+    table = db.zip_code
+    query = zip_code_datatables_query(dtr)
+    orderby = [
+        ~table[name] if descending else table[name]
+        for name, descending in dtr.order_columns
+    ] + [table.id]
+    limitby = (dtr.start, dtr.start + dtr.length) if dtr.length >= 0 else None
+    rows = db(query).select(*dtr.dal_fields, orderby=orderby, limitby=limitby)
+    return dict(
+        data=dtr.data(rows),
+        recordsTotal=db(table.id > 0).count(),
+        recordsFiltered=db(query).count(),
+    )
+
+
+class DataPathTest(unittest.TestCase):
+    def tearDown(self):
+        db.rollback()
+        db(db.zip_code.state.belongs(["ZZ", "YY"])).delete()
+        db.commit()
+
+    def check(self, name, vars, columnar=True):
+        dtr = zip_code_datatables_request(vars)
+        want = expected(dtr)
+        for values in SQL_SETTINGS:
+            with self.subTest(name, **values):
+                with mock.patch.multiple(settings, **values):
+                    self.assertEqual(zip_code_sql(dtr), want)
+        if columnar:
+            with self.subTest(name, columnar=True):
+                with mock.patch.object(settings, "DATATABLES_COLUMNAR", True):
+                    self.assertEqual(zip_code_columnar(dtr), want)
+
+    def test_pages(self):
+        for name, vars in REQUESTS.items():
+            self.check(name, vars)
+
+    def test_writes(self):
+        #  a filtered search (snapshots) and the first page (counts) after every write
+        requests = dict(
+            filtered=get_vars(filters=dict(state="ZZ")),
+            first_page=get_vars(order=[(1, "desc")]),
+        )
+
+        def check_all():
+            for name, vars in requests.items():
+                self.check(name, vars)
+
+        ids = [
+            db.zip_code.insert(zip_code="9999%d" % number, state="ZZ")
+            for number in range(3)
+        ]
+        db.commit()
+        check_all()
+
+        db.zip_code.insert(zip_code="99995", state="ZZ")
+        db.commit()
+        check_all()
+
+        db(db.zip_code.id == ids[0]).update(state="YY")
+        db.commit()
+        check_all()
+
+        db(db.zip_code.id == ids[1]).delete()
+        db.commit()
+        check_all()
+
+        generation = cache.generation("zip_code")
+        db.zip_code.insert(zip_code="99996", state="ZZ")
+        db(db.zip_code.id == ids[2]).delete()
+        db.rollback()
+        self.assertEqual(cache.generation("zip_code"), generation)
+        check_all()
+
+    @unittest.skipUnless(change_log.exists(), "migrate.py creates the change log")
+    def test_raw_writes(self):
+        #  writes outside the dal do not move the generation, the change log sees them.
+        #  the column store only follows the generation
+        vars = get_vars(filters=dict(state="ZZ"))
+        db.zip_code.insert(zip_code="99990", state="ZZ")
+        db.commit()
+        self.check("filtered", vars, columnar=False)
+        db.executesql("INSERT INTO zip_code (zip_code, state) VALUES ('99991', 'ZZ');")
+        db.executesql("UPDATE zip_code SET state = 'YY' WHERE zip_code = '99990';")
+        db.commit()
+        self.check("filtered", vars, columnar=False)
+
+
+if __name__ == "__main__":
+    unittest.main()